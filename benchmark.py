@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import run_nblast
+from run_nblast import BACKENDS, load_dps, metrics, nblast_all_by_all, nblast_dp_pair, nblast_list_to_list
+
+# (number of neurons, points per neuron)
+DEFAULT_SCALES = ((10, 200), (40, 500))
+BENCHMARKS = ("load_dps", "nblast_dp_pair", "nblast_list_to_list", "nblast_all_by_all")
+REPORT_VERSION = 1
+
+
+def synthetic_swc(path, num_points, rng, step=1.0, branch_prob=0.02, extent=200.0):
+    """Writes a random branching skeleton of num_points nodes to path.
+
+    Every node extends its parent by step in a slowly turning direction; with branch_prob a new
+    branch starts at a random earlier node instead.
+    """
+    points = np.zeros((num_points, 3))
+    directions = np.zeros((num_points, 3))
+    parents = np.full(num_points, -1, dtype=np.int64)
+    points[0] = rng.uniform(0, extent, 3)
+    directions[0] = _unit(rng.normal(size=3))
+    for i in range(1, num_points):
+        parent = int(rng.integers(0, i)) if rng.random() < branch_prob else i - 1
+        direction = _unit(directions[parent] + rng.normal(scale=0.3, size=3))
+        parents[i] = parent
+        directions[i] = direction
+        points[i] = points[parent] + step * direction
+    node_ids = np.arange(1, num_points + 1)
+    np.savetxt(
+        path,
+        np.c_[node_ids, np.zeros(num_points), points, np.ones(num_points), np.where(parents < 0, -1, parents + 1)],
+        fmt=["%d", "%d", "%.4f", "%.4f", "%.4f", "%.2f", "%d"],
+    )
+
+
+def _unit(v):
+    return v / np.linalg.norm(v)
+
+
+def make_synthetic_dataset(folder, num_neurons, num_points, seed=0) -> list:
+    """Writes num_neurons synthetic SWC files to folder and returns their IDs."""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    ids = [f"syn{i:06d}" for i in range(num_neurons)]
+    for rid in ids:
+        synthetic_swc(os.path.join(folder, f"{rid}.swc"), num_points, rng)
+    return ids
+
+
+def time_call(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, backends=BACKENDS, benchmarks=BENCHMARKS, repeats=3, workers=1,
+                   seed=0, data_dir=None) -> dict:
+    """Times every benchmark for every backend and (num_neurons, num_points) scale.
+
+    Data is generated from seed, so reports are comparable between versions (see compare_reports).
+    Each result holds the min/median seconds over repeats, the number of pairs scored per run
+    (0 for load_dps), pairs/sec of the median run and the metrics snapshot of all repeats.
+    """
+    with tempfile.TemporaryDirectory(dir=data_dir) as tmp_dir:
+        results = []
+        for num_neurons, num_points in scales:
+            folder = os.path.join(tmp_dir, f"n{num_neurons}_p{num_points}")
+            ids = make_synthetic_dataset(folder, num_neurons, num_points, seed=seed)
+            half = len(ids) // 2
+            for backend in backends:
+                dps = load_dps(ids, folder, backend=backend)
+                dp_pairs = [(dps[a], dps[b]) for a, b in zip(ids, ids[1:])]
+                jobs = {
+                    "load_dps": (lambda: load_dps(ids, folder, backend=backend), 0),
+                    "nblast_dp_pair": (lambda: [nblast_dp_pair(a, b) for a, b in dp_pairs], len(dp_pairs)),
+                    "nblast_list_to_list": (
+                        lambda: nblast_list_to_list(ids[:half], ids[half:], folder, folder, float("-inf"),
+                                                    backend=backend, workers=workers),
+                        half * (len(ids) - half),
+                    ),
+                    "nblast_all_by_all": (
+                        lambda: nblast_all_by_all(ids, folder, float("-inf"), backend=backend, workers=workers),
+                        len(ids) ** 2,
+                    ),
+                }
+                for name in benchmarks:
+                    fn, num_pairs = jobs[name]
+                    metrics.reset()
+                    times = time_call(fn, repeats)
+                    median = statistics.median(times)
+                    results.append({
+                        "benchmark": name,
+                        "backend": backend,
+                        "num_neurons": num_neurons,
+                        "num_points": num_points,
+                        "workers": workers,
+                        "seconds_min": min(times),
+                        "seconds_median": median,
+                        "pairs": num_pairs,
+                        "pairs_per_sec": num_pairs / median if num_pairs and median > 0 else None,
+                        "metrics": metrics.snapshot(),
+                    })
+                    run_nblast.tlog.report(f"[benchmark] {name} {backend} {num_neurons}x{num_points}: {median:.4f}s")
+    return {
+        "version": REPORT_VERSION,
+        "meta": {
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeats": repeats,
+            "seed": seed,
+            "dp_cache": run_nblast.DP_CACHE is not None,
+        },
+        "results": results,
+    }
+
+
+def _result_key(res):
+    return res["benchmark"], res["backend"], res["num_neurons"], res["num_points"], res["workers"]
+
+
+def compare_reports(old, new, tolerance=0.1) -> list:
+    """Median-time ratios (new / old) of every benchmark present in both reports.
+
+    Returns dicts with the benchmark key fields, both medians, the ratio and regression (ratio
+    above 1 + tolerance), slowest first.
+    """
+    old_results = {_result_key(res): res for res in old["results"]}
+    rows = []
+    for res in new["results"]:
+        key = _result_key(res)
+        if key not in old_results:
+            continue
+        old_median = old_results[key]["seconds_median"]
+        ratio = res["seconds_median"] / old_median if old_median > 0 else float("inf")
+        rows.append({
+            **dict(zip(("benchmark", "backend", "num_neurons", "num_points", "workers"), key)),
+            "old_seconds": old_median,
+            "new_seconds": res["seconds_median"],
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance,
+        })
+    return sorted(rows, key=lambda row: -row["ratio"])
+
+
+def _parse_scale(s):
+    num_neurons, num_points = s.lower().split("x")
+    return int(num_neurons), int(num_points)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark run_nblast on synthetic neurons")
+    parser.add_argument("--scales", nargs="+", type=_parse_scale, default=list(DEFAULT_SCALES),
+                        help="NEURONSxPOINTS, e.g. 10x200 40x500")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="JSON report of a previous version to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before flagging a regression")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.scales, args.backends, args.benchmarks, repeats=args.repeats, workers=args.workers,
+                            seed=args.seed)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    for res in report["results"]:
+        print(f"{res['benchmark']:20} {res['backend']:7} {res['num_neurons']:6}x{res['num_points']:<6} "
+              f"{res['seconds_median']:10.4f}s  {res['pairs_per_sec'] or 0:12.1f} pairs/s")
+    if args.compare:
+        with open(args.compare) as f:
+            rows = compare_reports(json.load(f), report, tolerance=args.tolerance)
+        for row in rows:
+            flag = "REGRESSION" if row["regression"] else ""
+            print(f"{row['benchmark']:20} {row['backend']:7} {row['num_neurons']:6}x{row['num_points']:<6} "
+                  f"{row['old_seconds']:10.4f}s -> {row['new_seconds']:10.4f}s  x{row['ratio']:.2f} {flag}")
+        if any(row["regression"] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DotpropsCache(object):
+    """On-disk cache of dotprops arrays keyed by SWC path, SWC content hash and dotprops parameters.
+
+    Every entry is one flat float64 .npy file holding the points, tangent vectors and alpha
+    blocks back to back, so that all three can be memory-mapped as contiguous views. Entries
+    are evicted least-recently-used first once the cache grows over max_bytes. The size is
+    tracked as a running total (read from disk once), so the directory is only scanned when
+    the total goes over max_bytes; writes by other processes are picked up at that point.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = self.size_bytes()
+
+    @staticmethod
+    def path_prefix(path):
+        return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+    def key(self, path, params):
+        # the path prefix lets invalidate() find the entries of a file after its content changed
+        params = dict(params, cache_version=CACHE_VERSION)
+        params_str = json.dumps(params, sort_keys=True)
+        return f"{self.path_prefix(path)}-{file_hash(path)}-{hashlib.sha1(params_str.encode()).hexdigest()[:16]}"
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        p = self.entry_path(key)
+        try:
+            flat = np.load(p, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        # mark as recently used for LRU eviction
+        os.utime(p)
+        self.hits += 1
+        n = len(flat) // 7
+        return flat[:3 * n].reshape(n, 3), flat[3 * n:6 * n].reshape(n, 3), flat[6 * n:]
+
+    def put(self, key, points, vect, alpha):
+        flat = np.concatenate([
+            np.asarray(points, dtype=np.float64).ravel(),
+            np.asarray(vect, dtype=np.float64).ravel(),
+            np.asarray(alpha, dtype=np.float64).ravel(),
+        ])
+        p = self.entry_path(key)
+        tmp = f"{p}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, flat)
+        try:
+            self.total_bytes -= os.path.getsize(p)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, p)
+        self.total_bytes += os.path.getsize(p)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        res = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".npy"):
+                continue
+            p = os.path.join(self.cache_dir, fname)
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                continue
+            res.append((st.st_mtime, st.st_size, p))
+        return res
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    def invalidate(self, path):
+        # removes every entry of path, whatever the content of the file was when it was cached
+        prefix = f"{self.path_prefix(path)}-"
+        for _, size, p in self.entries():
+            if os.path.basename(p).startswith(prefix):
+                os.remove(p)
+                self.total_bytes -= size
+
+    def clear(self):
+        for _, _, p in self.entries():
+            os.remove(p)
+        self.total_bytes = 0
+
+
+def cache_from_env():
+    cache_dir = os.environ.get("NBLAST_CACHE_DIR")
+    if not cache_dir:
+        return None
+    max_mb = os.environ.get("NBLAST_CACHE_MAX_MB")
+    max_bytes = int(float(max_mb) * 1024 ** 2) if max_mb else DEFAULT_MAX_BYTES
+    return DotpropsCache(cache_dir, max_bytes=max_bytes)
@@ -1,4 +1,12 @@
+import bisect
+import contextlib
+import cProfile
 import datetime
+import json
+import math
+import os
+import sys
+import time
 
 
 def time_now():
@@ -35,3 +43,198 @@ class TimingLogger(object):
 
     def time_past_seconds(self):
         return (time_now() - self.start_time).total_seconds()
+
+
+# upper bounds (seconds) of the latency histogram buckets, Prometheus style (cumulative, plus +Inf)
+LATENCY_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0, 100.0)
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.count += count
+        self.sum += value * count
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th quantile
+        if not self.count:
+            return None
+        seen = 0
+        for upper, c in zip(self.buckets + (math.inf,), self.counts):
+            seen += c
+            if seen >= q * self.count:
+                return upper
+        return math.inf
+
+    def state(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+    def merge(self, state):
+        for i, c in enumerate(state["counts"]):
+            self.counts[i] += c
+        self.count += state["count"]
+        self.sum += state["sum"]
+
+
+class Metrics(object):
+    """Counters, per-phase span latencies and per-pair scoring latencies of one process.
+
+    Spans are timed with span(name). If event_path is set, the end of every span is appended to it
+    as a JSON line. snapshot() summarises everything, to_json_line() / to_prometheus() export it,
+    and drain() / merge() move the numbers of worker processes into the parent.
+    """
+
+    def __init__(self, prefix="nblast", event_path=None):
+        self.prefix = prefix
+        self.event_path = event_path
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.spans = {}
+        self.pair_latency = Histogram()
+        self.peak_rss = peak_rss_bytes()
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_span(self, name, seconds):
+        if name not in self.spans:
+            self.spans[name] = Histogram()
+        self.spans[name].observe(seconds)
+
+    def observe_pairs(self, seconds, num_pairs=1):
+        # a batch of num_pairs scored in seconds counts as num_pairs observations of the mean latency
+        if num_pairs:
+            self.pair_latency.observe(seconds / num_pairs, count=num_pairs)
+            self.inc("pairs_scored", num_pairs)
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe_span(name, seconds)
+            if self.event_path:
+                self._emit({"event": "span", "span": name, "seconds": seconds, **fields})
+
+    def _emit(self, record):
+        record = {"ts": time.time(), "pid": os.getpid(), **record}
+        with open(self.event_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def snapshot(self):
+        self.peak_rss = max(filter(None, [self.peak_rss, peak_rss_bytes()]), default=None)
+        scoring_seconds = self.spans["scoring"].sum if "scoring" in self.spans else 0.0
+        return {
+            "counters": dict(self.counters),
+            "spans": {
+                name: {"count": h.count, "seconds": h.sum, "p50": h.quantile(0.5), "p95": h.quantile(0.95)}
+                for name, h in self.spans.items()
+            },
+            "pair_latency": {
+                "count": self.pair_latency.count,
+                "mean": self.pair_latency.sum / self.pair_latency.count if self.pair_latency.count else None,
+                "p50": self.pair_latency.quantile(0.5),
+                "p95": self.pair_latency.quantile(0.95),
+                "p99": self.pair_latency.quantile(0.99),
+            },
+            "pairs_per_sec": self.counters.get("pairs_scored", 0) / scoring_seconds if scoring_seconds else None,
+            "peak_rss_bytes": self.peak_rss,
+        }
+
+    def drain(self):
+        state = {
+            "counters": dict(self.counters),
+            "spans": {name: h.state() for name, h in self.spans.items()},
+            "pair_latency": self.pair_latency.state(),
+            "peak_rss": peak_rss_bytes(),
+        }
+        self.reset()
+        return state
+
+    def merge(self, state):
+        for name, value in state["counters"].items():
+            self.inc(name, value)
+        for name, h in state["spans"].items():
+            if name not in self.spans:
+                self.spans[name] = Histogram(h["buckets"])
+            self.spans[name].merge(h)
+        self.pair_latency.merge(state["pair_latency"])
+        self.peak_rss = max(filter(None, [self.peak_rss, state["peak_rss"]]), default=None)
+
+    def to_json_line(self, **fields):
+        return json.dumps({"ts": time.time(), "event": "snapshot", **fields, **self.snapshot()})
+
+    def to_prometheus(self):
+        p = self.prefix
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {value}"]
+
+        def histogram_lines(metric, h, labels=""):
+            res = []
+            cumulative = 0
+            for upper, c in zip(h.buckets + (math.inf,), h.counts):
+                cumulative += c
+                le = "+Inf" if upper == math.inf else repr(upper)
+                sep = "," if labels else ""
+                res.append(f'{metric}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+            braces = f"{{{labels}}}" if labels else ""
+            res += [f"{metric}_sum{braces} {h.sum}", f"{metric}_count{braces} {h.count}"]
+            return res
+
+        if self.spans:
+            lines.append(f"# TYPE {p}_span_seconds histogram")
+            for name, h in sorted(self.spans.items()):
+                lines += histogram_lines(f"{p}_span_seconds", h, f'span="{name}"')
+        lines.append(f"# TYPE {p}_pair_seconds histogram")
+        lines += histogram_lines(f"{p}_pair_seconds", self.pair_latency)
+        peak_rss = self.snapshot()["peak_rss_bytes"]
+        if peak_rss is not None:
+            lines += [f"# TYPE {p}_peak_rss_bytes gauge", f"{p}_peak_rss_bytes {peak_rss}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # .prom files get the Prometheus text format, anything else a JSON line appended
+        if str(path).endswith(".prom"):
+            with open(path, "w") as f:
+                f.write(self.to_prometheus())
+        else:
+            with open(path, "a") as f:
+                f.write(self.to_json_line() + "\n")
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """cProfile the block and dump the stats to path (pstats/snakeviz format) if given.
+
+    The phase spans are plain function calls, so py-spy and other sampling profilers attach to a
+    running job without any hook.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
@@ -0,0 +1,188 @@
+import numpy as np
+from pykdtree.kdtree import KDTree
+
+# nat.nblast smat.fcwb score matrix: rows are (right-closed) distance bins,
+# columns are (right-closed) absolute dot product bins
+SMAT_DIST_BREAKS = np.array(
+    [0, 0.75, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, 7, 8, 9, 10, 12, 14, 16, 20, 25, 30, 40, 500]
+)
+SMAT_DOT_BREAKS = np.linspace(0, 1, 11)
+SMAT_FCWB = np.array([
+    [9.50009681841246, 9.21508335662349, 9.21115065315115, 8.77846019988287, 9.16480790878709,
+     9.22670304852642, 9.98177124602054, 9.98769540562331, 10.8047703362607, 11.3892297520051],
+    [8.44775535484291, 9.04606831917705, 8.66795898209567, 8.62098080152923, 8.77627481345128,
+     8.99169678916886, 9.61799941175952, 9.49397224483499, 9.9038964289191, 10.5558600418055],
+    [7.81414322934284, 8.27557633457944, 8.18660682886048, 8.23731427922735, 8.15598516511639,
+     8.44982093548525, 9.00303252641918, 8.77951149081028, 9.07759820573496, 9.72735167147373],
+    [7.51616719646677, 7.68155524590478, 7.82523642940135, 7.79365902977448, 7.88687632703958,
+     8.03176502548019, 7.90419447261403, 7.89167667941778, 8.46217860141364, 9.35647238546052],
+    [6.9783147327761, 6.94307801953134, 7.07921765812687, 7.04965078503871, 7.2130628384463,
+     6.93874902118156, 7.63696822638669, 7.4002162293118, 8.24372400571991, 8.80558524903729],
+    [6.33719877733494, 6.51045037496395, 6.35737422729476, 6.73066764513181, 6.64133577166606,
+     6.68494299661635, 6.84521100428193, 6.96540340394039, 7.58420978365021, 8.30995640318606],
+    [5.73499742229333, 5.77656385564567, 5.87488116875011, 6.07846921345912, 6.02417745573855,
+     5.93648482795035, 6.16518921344934, 6.30063662788765, 6.95985181784445, 7.87373732354423],
+    [5.11581548287475, 5.02164949649811, 5.15657495321943, 5.10426523641483, 5.14093105810577,
+     5.10869075730527, 5.31350417757688, 5.3295303700301, 5.90895075813729, 6.51317233424717],
+    [4.23399496093427, 4.15794772207134, 4.20728157596594, 4.15459017748659, 4.12686066546627,
+     4.07336802392446, 4.13970890702555, 4.30027565331642, 4.57805060814703, 5.16486934998009],
+    [3.34026906899444, 3.3051324872601, 3.29598747412083, 3.26045243973712, 3.29236938733991,
+     3.17886713646518, 3.35977585932096, 3.35409654930982, 3.57637236900113, 3.97585033429852],
+    [2.49516039627968, 2.52098424995215, 2.52305843981493, 2.46950414929279, 2.48275585435263,
+     2.49589362243518, 2.53247964713067, 2.47889449294332, 2.57140862978384, 3.03387575286047],
+    [1.80239308584322, 1.78109465478104, 1.70675762037913, 1.77535908912846, 1.75289855885997,
+     1.75146698137153, 1.79082680877923, 1.71478695619744, 1.76591615076793, 2.11190542667794],
+    [1.23204089761119, 1.24902175781678, 1.15056046332701, 1.15360646172969, 1.10537643865398,
+     1.09095576409395, 1.11211340817387, 1.0739799591457, 1.21329534346802, 1.36231448114903],
+    [0.401029977653807, 0.405860318670642, 0.364813354157233, 0.445292761733466, 0.340571513975563,
+     0.338199499746287, 0.28008292141423, 0.257239082236011, 0.309758722887181, 0.460951328334644],
+    [-0.232687426817219, -0.284912539606733, -0.336660961477481, -0.341205197026599, -0.403612584363158,
+     -0.449623119741235, -0.410464639556653, -0.494928060332013, -0.486278922443352, -0.343856434129093],
+    [-0.720642343060965, -0.737187893583455, -0.791598721371623, -0.913295681308958, -0.865874510428618,
+     -0.929914609825734, -0.938060798925512, -0.949574939903263, -0.949001462020957, -0.892505828852155],
+    [-1.20775367451133, -1.22429143802357, -1.2328210224835, -1.31777889984332, -1.3345851397256,
+     -1.38169640073789, -1.39943889386218, -1.35585589894259, -1.36677833201497, -1.31413253590163],
+    [-1.64590453464875, -1.67268478052567, -1.69807588928856, -1.75618281243588, -1.79136287047847,
+     -1.87854037507812, -1.87418727262208, -1.91954256176612, -1.93941093200183, -1.93797132206708],
+    [-2.51777719454819, -2.54534918684165, -2.5397234879536, -2.54576319981858, -2.60681273498349,
+     -2.68594630871072, -2.66326887245257, -2.70184701924541, -2.78173786253938, -2.91227645240933],
+    [-3.96009040652025, -4.03138759725922, -4.07211802129466, -4.14735135252196, -4.33002990458046,
+     -4.42005336179794, -4.5079151442239, -4.79405146609799, -4.83321292801167, -5.08567253503641],
+    [-9.92103817171225, -10.08763000068, -10.0554347237019, -10.1026820447963, -10.0868240800316,
+     -9.91220186436133, -10.0799576279701, -9.95197881595302, -10.0536078316845, -10.1287588679926],
+])
+
+DEFAULT_K = 20
+
+
+class Dotprops(object):
+    def __init__(self, points, vect, alpha, self_score=None):
+        self.points = points
+        self.vect = vect
+        self.alpha = alpha
+        self._kdtree = None
+        self._self_score = self_score
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def kdtree(self):
+        if self._kdtree is None:
+            self._kdtree = KDTree(np.ascontiguousarray(self.points, dtype=np.float64))
+        return self._kdtree
+
+    @property
+    def self_score(self):
+        # every point is its own nearest neighbour at distance 0 with |dot| 1
+        if self._self_score is None:
+            self._self_score = float(len(self) * SMAT_FCWB[0, -1])
+        return self._self_score
+
+
+def read_swc(path):
+    data = np.loadtxt(path, comments="#", ndmin=2)
+    return np.ascontiguousarray(data[:, 2:5], dtype=np.float64)
+
+
+def read_swc_tree(path):
+    data = np.loadtxt(path, comments="#", ndmin=2)
+    points = np.ascontiguousarray(data[:, 2:5], dtype=np.float64)
+    return points, data[:, 0].astype(np.int64), data[:, 6].astype(np.int64)
+
+
+def tree_segments(node_ids, parents):
+    # unbranched segments (lists of point indices from the distal to the proximal end), like nat's SegList
+    idx = {nid: i for i, nid in enumerate(node_ids)}
+    parent_idx = np.array([idx.get(p, -1) for p in parents], dtype=np.int64)
+    num_children = np.bincount(parent_idx[parent_idx >= 0], minlength=len(node_ids))
+    segments = []
+    for i in np.nonzero(num_children != 1)[0]:
+        if parent_idx[i] < 0:
+            if num_children[i] == 0:
+                segments.append([i])
+            continue
+        seg = [i]
+        j = parent_idx[i]
+        while True:
+            seg.append(j)
+            if parent_idx[j] < 0 or num_children[j] != 1:
+                break
+            j = parent_idx[j]
+        segments.append(seg)
+    return segments
+
+
+def resample_tree(points, node_ids, parents, stepsize):
+    # points spaced stepsize apart along every segment, keeping branch points and end points
+    res = []
+    for seg in tree_segments(node_ids, parents):
+        seg_pts = points[seg]
+        if len(seg_pts) == 1:
+            res.append(seg_pts)
+            continue
+        arc = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(seg_pts, axis=0), axis=1))])
+        at = np.append(np.arange(0, arc[-1], stepsize), arc[-1])
+        res.append(np.stack([np.interp(at, arc, seg_pts[:, d]) for d in range(3)], axis=1))
+    res = np.concatenate(res)
+    # drop the copies of branch points shared by adjacent segments, keeping segment order
+    _, first = np.unique(res, axis=0, return_index=True)
+    return res[np.sort(first)]
+
+
+def budget_indices(num_points, max_points):
+    # evenly spaced subset of at most max_points point indices (in SWC order)
+    if not max_points or num_points <= max_points:
+        return np.arange(num_points)
+    return np.unique(np.linspace(0, num_points - 1, max_points).round().astype(np.int64))
+
+
+def make_dotprops(points, k=DEFAULT_K):
+    # same construction as nat::dotprops: first principal axis of the k nearest
+    # neighbours (including the point itself) of every point
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    if len(points) == 0:
+        raise ValueError("Cannot compute dotprops for an empty point set")
+    k = min(k, len(points))
+    _, nn_idx = KDTree(points).query(points, k=k)
+    nn_pts = points[nn_idx.reshape(len(points), k).astype(np.intp)]
+    centred = nn_pts - nn_pts.mean(axis=1, keepdims=True)
+    inertia = np.einsum("nki,nkj->nij", centred, centred)
+    eigvals, eigvecs = np.linalg.eigh(inertia)
+    vect = np.ascontiguousarray(eigvecs[:, :, -1])
+    totals = eigvals.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = np.where(totals > 0, (eigvals[:, -1] - eigvals[:, -2]) / totals, 0.0)
+    return Dotprops(points, vect, alpha)
+
+
+def load_points(path, resample=None, max_points=None):
+    if resample:
+        points = resample_tree(*read_swc_tree(path), resample)
+    else:
+        points = read_swc(path)
+    return points[budget_indices(len(points), max_points)]
+
+
+def load_dotprops(path, k=DEFAULT_K, resample=None, max_points=None):
+    return make_dotprops(load_points(path, resample=resample, max_points=max_points), k=k)
+
+
+def smat_scores(dists, dots):
+    dist_bins = np.searchsorted(SMAT_DIST_BREAKS[1:-1], dists, side="left")
+    dot_bins = np.searchsorted(SMAT_DOT_BREAKS[1:-1], dots, side="left")
+    return SMAT_FCWB[dist_bins, dot_bins]
+
+
+def nblast_raw(query, target):
+    dists, nn_idx = target.kdtree.query(query.points, k=1)
+    dots = np.abs(np.einsum("ij,ij->i", query.vect, target.vect[nn_idx.astype(np.intp)]))
+    return float(smat_scores(dists, dots).sum())
+
+
+def nblast_normalised(query, target):
+    return nblast_raw(query, target) / query.self_score
+
+
+def nblast_mean(dp1, dp2):
+    return (nblast_normalised(dp1, dp2) + nblast_normalised(dp2, dp1)) / 2
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+import nblast_native
+import prefilter
+
+MAGIC = b"NBLSTLIB"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# name -> (dtype, trailing shape) of every array block in a library file
+BLOCKS = {
+    "points": ("<f8", (3,)),
+    "vect": ("<f8", (3,)),
+    "alpha": ("<f8", ()),
+    "offsets": ("<i8", ()),
+    "self_scores": ("<f8", ()),
+    "bboxes": ("<f8", (2, 3)),
+    "voxel_centres": ("<f8", (3,)),
+    "voxel_counts": ("<i8", ()),
+    "voxel_offsets": ("<i8", ()),
+}
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_library(path, neurons, dp_params, voxel_size=prefilter.DEFAULT_VOXEL_SIZE) -> int:
+    """Packs (id, points, vect, alpha, self_score) tuples into one memory-mappable library file.
+
+    Layout: magic, little-endian uint64 header length, JSON header (ids, dotprops parameters and
+    dtype/shape/offset of every block), then the array blocks of BLOCKS, each 64-byte aligned and
+    with offsets counted from the aligned end of the header.
+    Neurons are streamed into per-block temporary files, so building never holds the whole
+    library in memory. Returns the number of neurons written.
+    """
+    ids = []
+    num_points, num_voxels = 0, 0
+    offsets, voxel_offsets = [0], [0]
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        parts = {name: open(os.path.join(tmp_dir, name), "wb") for name in BLOCKS}
+        try:
+            for rid, points, vect, alpha, self_score in neurons:
+                sig = prefilter.Signature(points, self_score, voxel_size=voxel_size)
+                ids.append(str(rid))
+                num_points += len(points)
+                num_voxels += len(sig.voxel_counts)
+                offsets.append(num_points)
+                voxel_offsets.append(num_voxels)
+                for name, arr in [
+                    ("points", points), ("vect", vect), ("alpha", alpha), ("self_scores", [self_score]),
+                    ("bboxes", sig.bbox), ("voxel_centres", sig.voxel_centres), ("voxel_counts", sig.voxel_counts),
+                ]:
+                    parts[name].write(np.ascontiguousarray(arr, dtype=BLOCKS[name][0]).tobytes())
+            parts["offsets"].write(np.asarray(offsets, dtype=BLOCKS["offsets"][0]).tobytes())
+            parts["voxel_offsets"].write(np.asarray(voxel_offsets, dtype=BLOCKS["voxel_offsets"][0]).tobytes())
+        finally:
+            for f in parts.values():
+                f.close()
+
+        lengths = {
+            "points": num_points, "vect": num_points, "alpha": num_points, "offsets": len(ids) + 1,
+            "self_scores": len(ids), "bboxes": len(ids), "voxel_centres": num_voxels, "voxel_counts": num_voxels,
+            "voxel_offsets": len(ids) + 1,
+        }
+        header = {
+            "version": FORMAT_VERSION,
+            "ids": ids,
+            "dp_params": dp_params,
+            "voxel_size": voxel_size,
+            "blocks": {},
+        }
+        # block offsets are relative to the (aligned) end of the header
+        pos = 0
+        for name, (dtype, shape) in BLOCKS.items():
+            header["blocks"][name] = {"dtype": dtype, "shape": [lengths[name], *shape], "offset": pos}
+            pos = _align(pos + os.path.getsize(os.path.join(tmp_dir, name)))
+        header_bytes = json.dumps(header).encode()
+        data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(MAGIC)
+            out.write(struct.pack("<Q", len(header_bytes)))
+            out.write(header_bytes)
+            for name in BLOCKS:
+                out.write(b"\0" * (data_start + header["blocks"][name]["offset"] - out.tell()))
+                with open(os.path.join(tmp_dir, name), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_path, path)
+    return len(ids)
+
+
+class NeuronLibrary(object):
+    """Read-only, memory-mapped view of a library file written by write_library.
+
+    Can be passed to the run_nblast query functions in place of a folder; ids=None then means
+    every neuron of the library.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not an NBLAST library file: {self.path}")
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len))
+        data_start = _align(len(MAGIC) + 8 + header_len)
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported library version {header['version']} in {self.path}")
+        self.ids = header["ids"]
+        self.dp_params = header["dp_params"]
+        self.voxel_size = header["voxel_size"]
+        self.index = {rid: i for i, rid in enumerate(self.ids)}
+        self.blocks = {}
+        for name, spec in header["blocks"].items():
+            shape = tuple(spec["shape"])
+            if shape[0] == 0:
+                self.blocks[name] = np.zeros(shape, dtype=spec["dtype"])
+            else:
+                self.blocks[name] = np.memmap(
+                    self.path, dtype=spec["dtype"], mode="r", offset=data_start + spec["offset"], shape=shape
+                )
+
+    def __getstate__(self):
+        # worker processes reopen the mmap instead of pickling it
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __eq__(self, other):
+        return isinstance(other, NeuronLibrary) and os.path.abspath(other.path) == os.path.abspath(self.path)
+
+    def __hash__(self):
+        return hash(os.path.abspath(self.path))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, rid):
+        return str(rid) in self.index
+
+    def __repr__(self):
+        return f"NeuronLibrary({self.path!r}, {len(self)} neurons)"
+
+    def arrays(self, rid):
+        i = self.index[str(rid)]
+        p0, p1 = self.blocks["offsets"][i:i + 2]
+        return self.blocks["points"][p0:p1], self.blocks["vect"][p0:p1], self.blocks["alpha"][p0:p1]
+
+    def self_score(self, rid):
+        return float(self.blocks["self_scores"][self.index[str(rid)]])
+
+    def native_dotprops(self, rid):
+        return nblast_native.Dotprops(*self.arrays(rid), self_score=self.self_score(rid))
+
+    def signature_set(self, ids=None):
+        rows = np.arange(len(self)) if ids is None else np.array([self.index[str(f)] for f in ids], dtype=np.int64)
+        voxel_offsets = self.blocks["voxel_offsets"]
+        voxel_rows = [np.arange(voxel_offsets[i], voxel_offsets[i + 1]) for i in rows]
+        voxel_idx = np.concatenate(voxel_rows) if len(rows) else np.zeros(0, dtype=np.int64)
+        return prefilter.SignatureSet(
+            np.asarray(self.blocks["bboxes"][rows]),
+            np.asarray(self.blocks["self_scores"][rows]),
+            np.asarray(self.blocks["voxel_centres"][voxel_idx]),
+            np.asarray(self.blocks["voxel_counts"][voxel_idx]),
+            np.full(len(voxel_idx), np.sqrt(3) * self.voxel_size / 2),
+            np.concatenate([np.full(len(v), i) for i, v in enumerate(voxel_rows)]) if len(rows) else voxel_idx,
+        )
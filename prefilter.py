@@ -0,0 +1,97 @@
+import numpy as np
+
+from nblast_native import SMAT_DIST_BREAKS, SMAT_FCWB
+
+# coarse voxel sketch resolution, in the same units as the SWC coordinates (and smat distances)
+DEFAULT_VOXEL_SIZE = 2.0
+
+# best possible smat score for a nearest-neighbour distance of at least d, per distance bin of d
+_SMAT_SUFFIX_MAX = np.maximum.accumulate(SMAT_FCWB.max(axis=1)[::-1])[::-1]
+
+
+def best_scores_beyond(min_dists):
+    bins = np.searchsorted(SMAT_DIST_BREAKS[1:-1], min_dists, side="left")
+    return _SMAT_SUFFIX_MAX[bins]
+
+
+class Signature(object):
+    """Cheap summary of a neuron used to bound its NBLAST scores from above.
+
+    The points are binned into a coarse voxel grid (voxel centres + point counts). Any point of a
+    voxel is at least (distance of the voxel centre to a bounding box - half the voxel diagonal)
+    away from every point inside that box, which bounds the best smat score each point can get.
+    """
+
+    def __init__(self, points, self_score, voxel_size=DEFAULT_VOXEL_SIZE):
+        points = np.asarray(points, dtype=np.float64)
+        self.bbox = np.stack([points.min(axis=0), points.max(axis=0)])
+        voxels, counts = np.unique(np.floor(points / voxel_size).astype(np.int64), axis=0, return_counts=True)
+        self.voxel_centres = (voxels + 0.5) * voxel_size
+        self.voxel_counts = counts
+        self.voxel_radius = np.sqrt(3) * voxel_size / 2
+        self.self_score = float(self_score)
+
+
+class SignatureSet(object):
+    """Stacked target signatures, so that bounds against all targets are computed in a few array ops."""
+
+    def __init__(self, bboxes, self_scores, voxel_centres, voxel_counts, voxel_radii, owners):
+        self.bboxes = bboxes
+        self.self_scores = self_scores
+        self.voxel_centres = voxel_centres
+        self.voxel_counts = voxel_counts
+        self.voxel_radii = voxel_radii
+        self.owners = owners
+
+    @classmethod
+    def from_signatures(cls, signatures):
+        return cls(
+            np.stack([s.bbox for s in signatures]),
+            np.array([s.self_score for s in signatures]),
+            np.concatenate([s.voxel_centres for s in signatures]),
+            np.concatenate([s.voxel_counts for s in signatures]),
+            np.concatenate([np.full(len(s.voxel_counts), s.voxel_radius) for s in signatures]),
+            np.concatenate([np.full(len(s.voxel_counts), i) for i, s in enumerate(signatures)]),
+        )
+
+    def __len__(self):
+        return len(self.bboxes)
+
+
+def _dist_to_boxes(pts, boxes):
+    # distance of every point (P, 3) to every box (B, 2, 3), shape (P, B)
+    below = boxes[None, :, 0, :] - pts[:, None, :]
+    above = pts[:, None, :] - boxes[None, :, 1, :]
+    return np.linalg.norm(np.maximum(np.maximum(below, above), 0), axis=2)
+
+
+def forward_bounds(query, targets, chunk_size=1024):
+    # upper bound of the raw score of query against every target
+    res = np.zeros(len(targets))
+    for t0 in range(0, len(targets), chunk_size):
+        dists = _dist_to_boxes(query.voxel_centres, targets.bboxes[t0:t0 + chunk_size])
+        best = best_scores_beyond(np.maximum(dists - query.voxel_radius, 0))
+        res[t0:t0 + chunk_size] = query.voxel_counts @ best
+    return res
+
+
+def reverse_bounds(query, targets):
+    # upper bound of the raw score of every target against query
+    dists = _dist_to_boxes(targets.voxel_centres, query.bbox[None])[:, 0]
+    best = best_scores_beyond(np.maximum(dists - targets.voxel_radii, 0))
+    return np.bincount(targets.owners, weights=targets.voxel_counts * best, minlength=len(targets))
+
+
+def upper_bounds(query, targets, normalisation="mean"):
+    fwd = forward_bounds(query, targets)
+    if normalisation == "raw":
+        return fwd
+    fwd = fwd / query.self_score
+    if normalisation == "forward":
+        return fwd
+    rev = reverse_bounds(query, targets) / targets.self_scores
+    if normalisation == "mean":
+        return (fwd + rev) / 2
+    elif normalisation == "min":
+        return np.minimum(fwd, rev)
+    return np.maximum(fwd, rev)
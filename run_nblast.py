@@ -1,26 +1,178 @@
+import argparse
+import heapq
 import json
+import multiprocessing
 import os
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
 from pathlib import Path
+from types import SimpleNamespace
 
-import rpy2.robjects as ro
-from rpy2.robjects.packages import importr
-from rpy2.robjects import r
+import numpy as np
 
-from instrumentation import TimingLogger
-
-r("options(rgl.useNULL=TRUE)")
-nat = importr("nat")
-nblast = importr("nat.nblast")
+import dp_cache
+import nblast_native
+import prefilter
+from neuron_library import NeuronLibrary, write_library
+from score_io import SCORE_FORMATS, scores_to_dict, write_scores
+from instrumentation import Metrics, TimingLogger, profiled, time_now
 
 tlog = TimingLogger("NBLAST/py")
 
-def load_dp(rid, folder):
-    dct = load_dps([rid], folder)
-    return dct[rid]
+# spans of the hot phases (swc_parse, dotprops_build, r_bridge, scoring, materialise), counters and
+# per-pair latencies; setting NBLAST_METRICS_JSONL appends every span to that file as a JSON line
+metrics = Metrics("nblast", event_path=os.environ.get("NBLAST_METRICS_JSONL"))
+
+# "r" scores through nat.nblast over rpy2, "native" uses the in-process engine in nblast_native
+BACKENDS = ("r", "native")
+DEFAULT_BACKEND = os.environ.get("NBLAST_BACKEND", "r")
+
+# pairwise jobs are split into tiles of at most TILE_SIZE x TILE_SIZE neurons when running on a worker pool
+TILE_SIZE = 64
+# tiles submitted to the pool per worker, finished tiles are only held until they are yielded
+TILES_IN_FLIGHT_PER_WORKER = 2
+
+# "raw" and "forward" are directed scores of the first neuron against the second, the others combine both directions
+NORMALISATIONS = ("raw", "forward", "mean", "min", "max")
+SYMMETRIC_NORMALISATIONS = ("mean", "min", "max")
+
+# dotprops construction: k nearest neighbours for tangents, optional resampling step size along the
+# skeleton and optional maximum number of points (evenly spaced subset in SWC order)
+DEFAULT_DP_OPTS = {"k": nblast_native.DEFAULT_K, "resample": None, "max_points": None}
+
+# persistent dotprops cache, enabled by setting NBLAST_CACHE_DIR (and optionally NBLAST_CACHE_MAX_MB)
+DP_CACHE = dp_cache.cache_from_env()
+
+
+# embedded R session with nat and nat.nblast, started on first use by the "r" backend so that the
+# native backend (and the worker processes running it) never need rpy2 or R
+_R = None
+
+
+def r_session():
+    global _R
+    if _R is None:
+        import rpy2.robjects as ro
+        from rpy2.robjects.packages import importr
+
+        ro.r("options(rgl.useNULL=TRUE)")
+        _R = SimpleNamespace(
+            ro=ro,
+            r=ro.r,
+            nat=importr("nat"),
+            nblast=importr("nat.nblast"),
+            as_dotprops=ro.r("""function(points, alpha, vect, k) {
+                colnames(points) <- c("X", "Y", "Z")
+                rlist <- list(points=points, alpha=alpha, vect=vect)
+                attr(rlist, "k") <- k
+                as.dotprops(rlist)
+            }"""),
+            budget_dotprops=ro.r("function(n, idx, k) nat::dotprops(nat::xyzmatrix(n)[idx, , drop=FALSE], k=k)"),
+            self_scores=ro.r("function(nl) sapply(nl, function(x) nat.nblast::nblast(x, x, normalised=FALSE))"),
+        )
+    return _R
+
+
+def check_backend(backend):
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown NBLAST backend '{backend}', expected one of {BACKENDS}")
+    return backend
+
+
+def dp_options(dp_opts=None):
+    dp_opts = dict(DEFAULT_DP_OPTS, **(dp_opts or {}))
+    if set(dp_opts) != set(DEFAULT_DP_OPTS):
+        raise ValueError(f"Unknown dotprops options {set(dp_opts) - set(DEFAULT_DP_OPTS)}")
+    return dp_opts
+
+
+def _r_matrix_to_np(m):
+    return np.fromiter(m, dtype=np.float64, count=len(m)).reshape(tuple(m.dim), order="F")
+
+
+def _np_to_r_matrix(a):
+    ro = r_session().ro
+    return ro.r.matrix(ro.FloatVector(np.asarray(a).ravel(order="F")), nrow=a.shape[0])
+
+
+def dp_to_arrays(dp):
+    if isinstance(dp, nblast_native.Dotprops):
+        return dp.points, dp.vect, dp.alpha
+    with metrics.span("r_bridge"):
+        return (
+            _r_matrix_to_np(dp.rx2("points")),
+            _r_matrix_to_np(dp.rx2("vect")),
+            np.fromiter(dp.rx2("alpha"), dtype=np.float64),
+        )
+
+
+def dp_from_arrays(points, vect, alpha, backend, k=nblast_native.DEFAULT_K):
+    if backend == "native":
+        return nblast_native.Dotprops(points, vect, alpha)
+    R = r_session()
+    with metrics.span("r_bridge"):
+        return R.as_dotprops(_np_to_r_matrix(points), R.ro.FloatVector(alpha), _np_to_r_matrix(vect), k)
+
+
+def resolve_ids(ids, folder):
+    # a NeuronLibrary can stand in for folder + ids, in which case ids=None means the whole library
+    if ids is None:
+        if not isinstance(folder, NeuronLibrary):
+            raise ValueError("ids can only be omitted when querying a NeuronLibrary")
+        return list(folder.ids)
+    return ids
+
+
+def dp_params(backend, dp_opts=None):
+    return dict(dp_options(dp_opts), backend=backend)
 
-def load_dps(ids, folder):
-    tlog.report(f"Loading DPs for {len(ids)} IDs")
+
+def build_dp(path, backend, dp_opts=None):
+    dp_opts = dp_options(dp_opts)
+    if backend == "native":
+        with metrics.span("swc_parse"):
+            points = nblast_native.load_points(path, resample=dp_opts["resample"], max_points=dp_opts["max_points"])
+        with metrics.span("dotprops_build"):
+            return nblast_native.make_dotprops(points, k=dp_opts["k"])
+    R = r_session()
+    with metrics.span("swc_parse"):
+        n = R.r['read.neuron'](path)
+    with metrics.span("dotprops_build"):
+        if dp_opts["resample"]:
+            n = R.nat.resample(n, stepsize=dp_opts["resample"])
+        if dp_opts["max_points"]:
+            num_points = R.nat.xyzmatrix(n).dim[0]
+            idx = nblast_native.budget_indices(num_points, dp_opts["max_points"])
+            return R.budget_dotprops(n, R.ro.IntVector((idx + 1).tolist()), dp_opts["k"])
+        return R.nat.dotprops(n, k=dp_opts["k"])
+
+
+def load_dp_file(path, backend, cache=None, dp_opts=None):
+    if cache is None:
+        return build_dp(path, backend, dp_opts)
+    key = cache.key(path, dp_params(backend, dp_opts))
+    arrays = cache.get(key)
+    if arrays is not None:
+        return dp_from_arrays(*arrays, backend, k=dp_options(dp_opts)["k"])
+    dp = build_dp(path, backend, dp_opts)
+    cache.put(key, *dp_to_arrays(dp))
+    return dp
+
+
+def load_dp(rid, folder, backend=None, cache=None, dp_opts=None):
+    dct = load_dps([rid], folder, backend=backend, cache=cache, dp_opts=dp_opts)
+    return dct[str(rid)]
+
+def load_dps(ids, folder, backend=None, cache=None, dp_opts=None):
+    backend = check_backend(backend)
+    ids = resolve_ids(ids, folder)
+    if isinstance(folder, NeuronLibrary):
+        return _load_library_dps(ids, folder, backend, dp_opts)
+    cache = cache or DP_CACHE
+    tlog.report(f"Loading DPs for {len(ids)} IDs ({backend})")
     base_dir = os.path.join(os.getcwd(), folder)
 
     def to_swc_fname(f):
@@ -33,76 +185,594 @@ def load_dps(ids, folder):
         if not os.path.exists(p):
             raise FileNotFoundError(f"SWC file not found: {p}")
 
+    if backend == "r":
+        # start R up front so that a missing rpy2/R/nat fails the call instead of every single file
+        r_session()
+
     dps_dict = {}
     for f, p in zip(ids, paths):
         try:
-            n = r['read.neuron'](p)
-            dps_dict[str(f)] = nat.dotprops(n)
+            dps_dict[str(f)] = load_dp_file(p, backend, cache, dp_opts)
         except Exception as e:
+            metrics.inc("dps_failed")
             tlog.report(f"Exception for {f}: {e}")
+    metrics.inc("dps_loaded", len(dps_dict))
 
+    if cache is not None:
+        tlog.report(f"Loaded {len(dps_dict)} DPs out of {len(ids)} (cache: {cache.hits} hits, {cache.misses} misses)")
+    else:
+        tlog.report(f"Loaded {len(dps_dict)} DPs out of {len(ids)}")
+    return dps_dict
+
+
+def _load_library_dps(ids, library, backend, dp_opts=None):
+    tlog.report(f"Loading DPs for {len(ids)} IDs from {library} ({backend})")
+    lib_opts = dp_options({k: v for k, v in library.dp_params.items() if k in DEFAULT_DP_OPTS})
+    if dp_opts is not None and dp_options(dp_opts) != lib_opts:
+        raise ValueError(f"{library} was built with dotprops options {lib_opts}, not {dp_opts}")
+    missing = [f for f in ids if f not in library]
+    if missing:
+        raise KeyError(f"{len(missing)} IDs not found in {library}, e.g. {missing[0]}")
+    if backend == "native":
+        dps_dict = {str(f): library.native_dotprops(f) for f in ids}
+    else:
+        dps_dict = {str(f): dp_from_arrays(*library.arrays(f), backend, k=lib_opts["k"]) for f in ids}
+    metrics.inc("dps_loaded", len(dps_dict))
     tlog.report(f"Loaded {len(dps_dict)} DPs out of {len(ids)}")
     return dps_dict
 
 
-def nblast_file_path_pair(file1, file2):
+def build_library(ids, folder, path, backend=None, chunk_size=1000, voxel_size=prefilter.DEFAULT_VOXEL_SIZE,
+                  dp_opts=None) -> int:
+    """Packs the dotprops, self-scores and prefilter signatures of ids into one library file.
+
+    The result can be opened with NeuronLibrary and passed to the query functions in place of folder.
+    """
+    backend = check_backend(backend)
+    ids = list(ids)
+
+    def neurons():
+        for c in _chunks(ids, chunk_size):
+            dps_dict = load_dps(c, folder, backend=backend, dp_opts=dp_opts)
+            for (rid, dp), sc in zip(dps_dict.items(), self_scores(dps_dict)):
+                yield (rid, *dp_to_arrays(dp), sc)
+
+    num_written = write_library(path, neurons(), dp_params(backend, dp_opts), voxel_size=voxel_size)
+    tlog.report(f"[build_library] Wrote {num_written} neurons to {path}")
+    return num_written
+
+
+def nblast_file_path_pair(file1, file2, backend=None, dp_opts=None):
     path1, path2 = Path(file1), Path(file2)
-    return nblast_id_pair(path1.stem, path2.stem, str(path1.parent), str(path2.parent))
+    return nblast_id_pair(path1.stem, path2.stem, str(path1.parent), str(path2.parent), backend=backend,
+                          dp_opts=dp_opts)
 
 
-def nblast_id_pair(id1: str, id2: str, folder1: str, folder2: str) -> float:
-    return nblast_dp_pair(load_dp(id1, folder1), load_dp(id2, folder2))
+def nblast_id_pair(id1: str, id2: str, folder1: str, folder2: str, backend=None, dp_opts=None) -> float:
+    return nblast_dp_pair(load_dp(id1, folder1, backend=backend, dp_opts=dp_opts),
+                          load_dp(id2, folder2, backend=backend, dp_opts=dp_opts))
 
 
 def nblast_dp_pair(dp1, dp2) -> float:
-    score1 = nblast.nblast(dp1, dp2, normalised=True)
-    score2 = nblast.nblast(dp2, dp1, normalised=True)
-    return (score1[0] + score2[0]) / 2
-
-
-def nblast_all_by_all(ids, folder, min_score) -> dict:
-    dps_dict = load_dps(ids, folder)
-    tlog.report(f"Running all by all nblast for {len(dps_dict)} SWCs")
-    res_vec = nblast.nblast_allbyall(nat.as_neuronlist(ro.ListVector(dps_dict)), normalisation="mean")
-    tlog.report(f"Storing scores in dict {len(dps_dict)} SWCs")
-    dimnames = res_vec.do_slot("dimnames")
-    rownames = list(dimnames[0])
-    colnames = list(dimnames[1])
-    res_dict = {
-        (rrid, crid): res_vec[i * len(ids) + j]
-        for i, rrid in enumerate(rownames)
-        for j, crid in enumerate(colnames)
-    }
-    res_dict = {k: v for k, v in res_dict.items() if v >= min_score}
+    start = time.perf_counter()
+    with metrics.span("scoring"):
+        if isinstance(dp1, nblast_native.Dotprops):
+            score = nblast_native.nblast_mean(dp1, dp2)
+        else:
+            nblast = r_session().nblast
+            score = (nblast.nblast(dp1, dp2, normalised=True)[0] + nblast.nblast(dp2, dp1, normalised=True)[0]) / 2
+    metrics.observe_pairs(time.perf_counter() - start, 2)
+    return score
+
+
+def directed_scores(query_dps, target_dps):
+    # raw (unnormalised) NBLAST scores, rows are queries and columns are targets
+    if not query_dps or not target_dps:
+        return np.zeros((len(query_dps), len(target_dps)))
+    first = next(iter(query_dps.values()))
+    if isinstance(first, nblast_native.Dotprops):
+        res = np.empty((len(query_dps), len(target_dps)))
+        with metrics.span("scoring", pairs=res.size):
+            for i, qdp in enumerate(query_dps.values()):
+                for j, tdp in enumerate(target_dps.values()):
+                    start = time.perf_counter()
+                    res[i, j] = nblast_native.nblast_raw(qdp, tdp)
+                    metrics.observe_pairs(time.perf_counter() - start)
+        return res
+    R = r_session()
+    with metrics.span("r_bridge"):
+        query_nl = R.nat.as_neuronlist(R.ro.ListVector(query_dps))
+        target_nl = R.nat.as_neuronlist(R.ro.ListVector(target_dps))
+    # a single R call scores the whole block, so every pair gets the mean latency of the block
+    start = time.perf_counter()
+    with metrics.span("scoring", pairs=len(query_dps) * len(target_dps)):
+        res = R.nblast.nblast(query_nl, target_nl, normalised=False)
+    metrics.observe_pairs(time.perf_counter() - start, len(query_dps) * len(target_dps))
+    with metrics.span("r_bridge"):
+        # nat.nblast returns targets in rows and queries in columns (a plain vector if either has length 1)
+        return np.fromiter(res, dtype=np.float64, count=len(res)).reshape(
+            (len(target_dps), len(query_dps)), order="F"
+        ).T
+
+
+def self_scores(dps_dict):
+    if not dps_dict:
+        return np.zeros(0)
+    first = next(iter(dps_dict.values()))
+    if isinstance(first, nblast_native.Dotprops):
+        return np.array([dp.self_score for dp in dps_dict.values()])
+    R = r_session()
+    with metrics.span("r_bridge"):
+        nl = R.nat.as_neuronlist(R.ro.ListVector(dps_dict))
+    with metrics.span("scoring", pairs=len(dps_dict)):
+        res = R.self_scores(nl)
+    with metrics.span("r_bridge"):
+        return np.fromiter(res, dtype=np.float64, count=len(res))
+
+
+def _known_self_scores(dps_dict, cache, known):
+    # raw self-scores of dps_dict, only computing those missing from cache and known (id -> self-score);
+    # known and computed values are added to cache if one is given
+    cache = {} if cache is None else cache
+    cache.update(known)
+    missing = {rid: dp for rid, dp in dps_dict.items() if rid not in cache}
+    cache.update(zip(missing, self_scores(missing)))
+    return np.array([cache[rid] for rid in dps_dict])
+
+
+def score_matrix(dps_dict_1, dps_dict_2, normalisation="mean", self_scores_1=None, self_scores_2=None):
+    """Scores of every neuron in dps_dict_1 against every neuron in dps_dict_2.
+
+    Every directed NBLAST is evaluated at most once: reverse scores of pairs where both dotprops
+    appear on both sides (e.g. all-by-all) are read off the forward matrix, and so are the
+    self-scores of those neurons. self_scores_1/self_scores_2 (id -> raw self-score) are caches
+    kept by the caller across calls: known values are read from them and computed ones added.
+    Returns a len(dps_dict_1) x len(dps_dict_2) array.
+    """
+    if normalisation not in NORMALISATIONS:
+        raise ValueError(f"Unknown normalisation '{normalisation}', expected one of {NORMALISATIONS}")
+    ids1, ids2 = list(dps_dict_1.keys()), list(dps_dict_2.keys())
+    fwd = directed_scores(dps_dict_1, dps_dict_2)
+    if normalisation == "raw":
+        return fwd
+
+    # neurons that are the very same dotprops on both sides
+    shared = {rid for rid in ids2 if rid in dps_dict_1 and dps_dict_1[rid] is dps_dict_2[rid]}
+    pos1 = {rid: i for i, rid in enumerate(ids1)}
+    pos2 = {rid: j for j, rid in enumerate(ids2)}
+
+    diag = {}
+    if shared and not isinstance(dps_dict_1[next(iter(shared))], nblast_native.Dotprops):
+        # the forward matrix already holds the self-scores of shared neurons (native ones are free anyway)
+        diag = {rid: fwd[pos1[rid], pos2[rid]] for rid in shared}
+    self1 = _known_self_scores(dps_dict_1, self_scores_1, diag)
+    self2 = _known_self_scores(dps_dict_2, self_scores_2, {rid: self1[pos1[rid]] for rid in shared})
+    fwd_n = fwd / self1[:, None]
+    if normalisation == "forward":
+        return fwd_n
+
+    # rev[j, i] is the raw score of ids2[j] queried against ids1[i]
+    rev = np.empty((len(ids2), len(ids1)))
+    rows_shared = [j for j, rid in enumerate(ids2) if rid in shared]
+    rows_own = [j for j, rid in enumerate(ids2) if rid not in shared]
+    cols_shared = [i for i, rid in enumerate(ids1) if rid in shared]
+    cols_own = [i for i, rid in enumerate(ids1) if rid not in shared]
+    if rows_shared and cols_shared:
+        rev[np.ix_(rows_shared, cols_shared)] = fwd[
+            np.ix_([pos1[ids2[j]] for j in rows_shared], [pos2[ids1[i]] for i in cols_shared])
+        ]
+    if rows_shared and cols_own:
+        rev[np.ix_(rows_shared, cols_own)] = directed_scores(
+            {ids2[j]: dps_dict_2[ids2[j]] for j in rows_shared}, {ids1[i]: dps_dict_1[ids1[i]] for i in cols_own}
+        )
+    if rows_own:
+        rev[rows_own, :] = directed_scores({ids2[j]: dps_dict_2[ids2[j]] for j in rows_own}, dps_dict_1)
+    rev_n = (rev / self2[:, None]).T
+
+    if normalisation == "mean":
+        return (fwd_n + rev_n) / 2
+    elif normalisation == "min":
+        return np.minimum(fwd_n, rev_n)
+    else:
+        return np.maximum(fwd_n, rev_n)
+
+
+def nblast_all_by_all(ids, folder, min_score, backend=None, workers=1, tile_size=TILE_SIZE,
+                      normalisation="mean", dp_opts=None) -> dict:
+    ids = [str(f) for f in resolve_ids(ids, folder)]
+    tlog.report(f"Running all by all nblast for {len(ids)} SWCs")
+    res_dict = scores_to_dict(ids, ids, iter_scores(
+        ids, ids, folder, folder, min_score, backend=backend, workers=workers, tile_size=tile_size,
+        normalisation=normalisation, dp_opts=dp_opts,
+    ))
     tlog.report(f"[nblast_all_by_all] Stored {len(res_dict)} scores >{min_score}")
     return res_dict
 
 
-def nblast_list_to_list(ids1, ids2, folder1, folder2, min_score) -> dict:
-    dps_dict_1 = load_dps(ids1, folder1)
-    dps_dict_2 = load_dps(ids2, folder2)
-    tlog.report(f"Running list to list nblast for {len(dps_dict_1)} X {len(dps_dict_2)} SWCs")
+def nblast_list_to_list(ids1, ids2, folder1, folder2, min_score, backend=None, workers=1,
+                        tile_size=TILE_SIZE, normalisation="mean", dp_opts=None) -> dict:
+    ids1, ids2 = [str(f) for f in resolve_ids(ids1, folder1)], [str(f) for f in resolve_ids(ids2, folder2)]
+    tlog.report(f"Running list to list nblast for {len(ids1)} X {len(ids2)} SWCs")
+    res_dict = scores_to_dict(ids1, ids2, iter_scores(
+        ids1, ids2, folder1, folder2, min_score, backend=backend, workers=workers, tile_size=tile_size,
+        normalisation=normalisation, dp_opts=dp_opts,
+    ))
+    if normalisation in SYMMETRIC_NORMALISATIONS:
+        # symmetric scores are also stored as (id2, id1)
+        res_dict.update({(f2, f1): sc for (f1, f2), sc in list(res_dict.items())})
+    tlog.report(f"[nblast_list_to_list] Stored {len(res_dict)} scores >{min_score}")
+    return res_dict
+
+
+def _load_dps_pair(ids1, ids2, folder1, folder2, backend, dp_opts=None):
+    if folder1 != folder2:
+        return (load_dps(ids1, folder1, backend=backend, dp_opts=dp_opts),
+                load_dps(ids2, folder2, backend=backend, dp_opts=dp_opts))
+    # load neurons present in both lists once so that score_matrix can reuse their directed scores
+    ids = list(dict.fromkeys(list(ids1) + list(ids2)))
+    dps_dict = load_dps(ids, folder1, backend=backend, dp_opts=dp_opts)
+    dps_dict_1 = {str(f): dps_dict[str(f)] for f in ids1 if str(f) in dps_dict}
+    dps_dict_2 = {str(f): dps_dict[str(f)] for f in ids2 if str(f) in dps_dict}
+    return dps_dict_1, dps_dict_2
+
+
+def _chunks(lst, size):
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+
+def iter_scores(ids1, ids2, folder1, folder2, min_score, backend=None, workers=1, tile_size=TILE_SIZE,
+                normalisation="mean", dp_opts=None):
+    """Yields (rows, cols, scores) arrays of the scores >= min_score, one tile at a time.
+
+    rows and cols index into ids1 and ids2. With one folder and a symmetric normalisation, the
+    neurons in both lists are scored as an all-by-all of their own (upper triangle of tiles,
+    mirrored), and every other tile has no neuron on both sides, so no directed NBLAST is
+    evaluated twice whatever the overlap or order of the lists.
+    Nothing larger than a tile is ever materialised (with workers > 1, at most
+    TILES_IN_FLIGHT_PER_WORKER tiles per worker), see score_io.write_scores to stream to a file.
+    """
+    backend = check_backend(backend)
+    ids1, ids2 = [str(f) for f in resolve_ids(ids1, folder1)], [str(f) for f in resolve_ids(ids2, folder2)]
+    pos1 = {f: i for i, f in enumerate(ids1)}
+    pos2 = {f: j for j, f in enumerate(ids2)}
+    symmetric = folder1 == folder2 and normalisation in SYMMETRIC_NORMALISATIONS
+    shared = [f for f in pos1 if f in pos2] if symmetric else []
+    shared_set = set(shared)
+    own1 = [f for f in pos1 if f not in shared_set]
+    own2 = [f for f in pos2 if f not in shared_set]
+
+    # (tile ids1, tile ids2, mirrored); diagonal tiles of the shared block come first, with shared dotprops
+    # their forward matrices hold the self-scores for the other tiles
+    shared_chunks = _chunks(shared, tile_size)
+    tiles = [(c, c, False) for c in shared_chunks]
+    tiles += [(c1, c2, True) for i, c1 in enumerate(shared_chunks) for c2 in shared_chunks[i + 1:]]
+    tiles += [(c1, c2, False) for c1 in shared_chunks for c2 in _chunks(own2, tile_size)]
+    tiles += [(c1, c2, False) for c1 in _chunks(own1, tile_size) for c2 in _chunks(list(pos2), tile_size)]
+    tlog.report(f"Streaming nblast scores for {len(ids1)} X {len(ids2)} SWCs in {len(tiles)} tiles")
+
+    # position in ids1 of every ids2 entry and vice versa, for mirroring tiles of the shared block
+    pos1_of_2 = np.array([pos1.get(f, -1) for f in ids2], dtype=np.int64)
+    pos2_of_1 = np.array([pos2.get(f, -1) for f in ids1], dtype=np.int64)
+
+    def finish(mirrored, coo):
+        rows, cols, scores = coo
+        if mirrored:
+            rows, cols, scores = (
+                np.concatenate([rows, pos1_of_2[cols]]), np.concatenate([cols, pos2_of_1[rows]]),
+                np.concatenate([scores, scores]),
+            )
+        metrics.inc("scores_stored", len(scores))
+        return rows, cols, scores
+
+    if workers > 1:
+        # R is not fork safe, so workers are spawned and start their own interpreter; every worker loads
+        # the dotprops of its tile once
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            todo = iter(tiles)
+            futures = {}
+            num_done = 0
+
+            def submit_next():
+                for tile_ids1, tile_ids2, mirrored in todo:
+                    fut = pool.submit(
+                        _score_tile_coo, tile_ids1, tile_ids2, [pos1[f] for f in tile_ids1],
+                        [pos2[f] for f in tile_ids2], folder1, folder2, min_score, backend, normalisation, dp_opts
+                    )
+                    futures[fut] = mirrored
+                    return
+
+            for _ in range(TILES_IN_FLIGHT_PER_WORKER * workers):
+                submit_next()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                while done:
+                    # drop every reference to the future (and its result) before yielding the tile
+                    fut = done.pop()
+                    mirrored = futures.pop(fut)
+                    coo, tile_metrics = fut.result()
+                    del fut
+                    metrics.merge(tile_metrics)
+                    submit_next()
+                    num_done += 1
+                    tlog.report(f"Finished {num_done} of {len(tiles)} tiles")
+                    yield finish(mirrored, coo)
+        return
+
+    dps_dict_1, dps_dict_2 = _load_dps_pair(ids1, ids2, folder1, folder2, backend, dp_opts)
+    # self-scores are computed once per neuron across tiles; with one folder both sides share the dotprops
+    self_1 = {}
+    self_2 = self_1 if folder1 == folder2 else {}
+    for tile_ids1, tile_ids2, mirrored in tiles:
+        yield finish(mirrored, _tile_coo(
+            {f: dps_dict_1[f] for f in tile_ids1 if f in dps_dict_1},
+            {f: dps_dict_2[f] for f in tile_ids2 if f in dps_dict_2},
+            pos1, pos2, min_score, normalisation, self_1, self_2,
+        ))
+
+
+def _tile_coo(dps_dict_1, dps_dict_2, pos1, pos2, min_score, normalisation, self_1=None, self_2=None):
+    if not dps_dict_1 or not dps_dict_2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    scores = score_matrix(dps_dict_1, dps_dict_2, normalisation, self_scores_1=self_1, self_scores_2=self_2)
+    with metrics.span("materialise"):
+        rows = np.array([pos1[f] for f in dps_dict_1.keys()], dtype=np.int64)
+        cols = np.array([pos2[f] for f in dps_dict_2.keys()], dtype=np.int64)
+        i, j = np.nonzero(scores >= min_score)
+    return rows[i], cols[j], scores[i, j]
+
+
+def _score_tile_coo(ids1, ids2, rows, cols, folder1, folder2, min_score, backend, normalisation, dp_opts=None):
+    # runs in a worker process; rows and cols are the positions of ids1 and ids2 in the full lists
+    dps_dict_1, dps_dict_2 = _load_dps_pair(ids1, ids2, folder1, folder2, backend, dp_opts)
+    coo = _tile_coo(dps_dict_1, dps_dict_2, dict(zip(ids1, rows)), dict(zip(ids2, cols)), min_score, normalisation)
+    return coo, metrics.drain()
+
+
+def signatures(dps_dict, voxel_size=prefilter.DEFAULT_VOXEL_SIZE, scores=None):
+    # scores: raw self-scores in dps_dict order, computed if not given
+    scores = self_scores(dps_dict) if scores is None else scores
+    return [
+        prefilter.Signature(dp_to_arrays(dp)[0], sc, voxel_size=voxel_size)
+        for dp, sc in zip(dps_dict.values(), scores)
+    ]
+
+
+def nblast_top_k(query_ids, target_ids, k, query_folder, target_folder, backend=None, normalisation="mean",
+                 prefilter_targets=True, batch_size=32, voxel_size=prefilter.DEFAULT_VOXEL_SIZE,
+                 dp_opts=None) -> dict:
+    """Best k targets for every query, as {query_id: [(target_id, score), ...]} sorted by score.
+
+    With prefilter_targets, targets are scored in decreasing order of an upper bound of their score
+    (prefilter.upper_bounds) and the scan stops as soon as the k-th best score is at least the
+    bound of the next target. The bounds are exact, so the result is the same as scoring everything.
+    """
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    backend = check_backend(backend)
+    query_dps = load_dps(query_ids, query_folder, backend=backend, dp_opts=dp_opts)
+    target_dps = load_dps(target_ids, target_folder, backend=backend, dp_opts=dp_opts)
+    tids = list(target_dps.keys())
+    # every self-score is computed (or read from the library) once, not once per query and batch
+    query_self, target_self = {}, {}
+    if prefilter_targets or normalisation != "raw":
+        query_self = dict(zip(query_dps, self_scores(query_dps)))
+        if isinstance(target_folder, NeuronLibrary):
+            target_self = {tid: target_folder.self_score(tid) for tid in tids}
+        else:
+            target_self = dict(zip(tids, self_scores(target_dps)))
+    if prefilter_targets:
+        if isinstance(target_folder, NeuronLibrary) and target_folder.voxel_size == voxel_size:
+            target_sigs = target_folder.signature_set(tids)
+        else:
+            target_sigs = prefilter.SignatureSet.from_signatures(
+                signatures(target_dps, voxel_size=voxel_size, scores=[target_self[tid] for tid in tids])
+            )
+        query_sigs = dict(zip(query_dps.keys(), signatures(
+            query_dps, voxel_size=voxel_size, scores=[query_self[qid] for qid in query_dps]
+        )))
+    tlog.report(f"Running top {k} nblast for {len(query_dps)} queries against {len(tids)} targets")
+
     res_dict = {}
-    for f1, dp1 in dps_dict_1.items():
-        for f2, dp2 in dps_dict_2.items():
-            sc = float(nblast_dp_pair(dp1, dp2))
-            if sc >= min_score:
+    num_scored = 0
+    for qid, qdp in query_dps.items():
+        if prefilter_targets:
+            bounds = prefilter.upper_bounds(query_sigs[qid], target_sigs, normalisation)
+            order = np.argsort(-bounds, kind="stable")
+        else:
+            bounds, order = None, np.arange(len(tids))
+        best = []
+        for b0 in range(0, len(order), batch_size):
+            # small slack so that rounding in the bound can never prune a tie
+            if bounds is not None and len(best) == k and best[0][0] >= bounds[order[b0]] + 1e-9:
+                break
+            batch = [tids[j] for j in order[b0:b0 + batch_size]]
+            scores = score_matrix({qid: qdp}, {tid: target_dps[tid] for tid in batch}, normalisation,
+                                  self_scores_1=query_self, self_scores_2=target_self)[0]
+            num_scored += len(batch)
+            for tid, sc in zip(batch, scores):
+                if len(best) < k:
+                    heapq.heappush(best, (float(sc), tid))
+                elif sc > best[0][0]:
+                    heapq.heapreplace(best, (float(sc), tid))
+        res_dict[qid] = [(tid, sc) for sc, tid in sorted(best, reverse=True)]
+
+    total = len(query_dps) * len(tids)
+    metrics.inc("pairs_pruned", total - num_scored)
+    tlog.report(f"[nblast_top_k] Scored {num_scored} of {total} pairs ({total - num_scored} pruned)")
+    return res_dict
+
+
+def nblast_coarse_to_fine(ids1, ids2, folder1, folder2, min_score, threshold, coarse_opts, fine_opts=None,
+                          backend=None, workers=1, tile_size=TILE_SIZE, normalisation="mean") -> dict:
+    """Scores every pair with coarse dotprops, then rescores pairs >= threshold with fine dotprops.
+
+    Pairs are only kept if their fine score is >= min_score. threshold should sit below min_score
+    by the drift that coarse_opts introduces (see resolution_drift_report), pairs below it are
+    never rescored.
+    """
+    backend = check_backend(backend)
+    ids1, ids2 = [str(f) for f in resolve_ids(ids1, folder1)], [str(f) for f in resolve_ids(ids2, folder2)]
+    candidates = {}
+    for rows, cols, _ in iter_scores(ids1, ids2, folder1, folder2, threshold, backend=backend, workers=workers,
+                                     tile_size=tile_size, normalisation=normalisation, dp_opts=coarse_opts):
+        for i, j in zip(rows, cols):
+            candidates.setdefault(ids1[i], []).append(ids2[j])
+    num_candidates = sum(len(v) for v in candidates.values())
+    tlog.report(f"Rescoring {num_candidates} of {len(ids1) * len(ids2)} pairs with coarse scores >{threshold}")
+
+    dps_dict_1, dps_dict_2 = _load_dps_pair(
+        list(candidates), list(dict.fromkeys(f for v in candidates.values() for f in v)), folder1, folder2, backend,
+        fine_opts,
+    )
+    # with one folder both sides share the fine dotprops, so symmetric scores of pairs already rescored the
+    # other way round are reused (every score_matrix call computes both directions) and so are self-scores
+    symmetric = folder1 == folder2 and normalisation in SYMMETRIC_NORMALISATIONS
+    self_1 = {}
+    self_2 = self_1 if folder1 == folder2 else {}
+    fine = {}
+    for f1, f2s in candidates.items():
+        if f1 not in dps_dict_1:
+            continue
+        targets = {f2: dps_dict_2[f2] for f2 in f2s if f2 in dps_dict_2 and not (symmetric and (f2, f1) in fine)}
+        if targets:
+            scores = score_matrix({f1: dps_dict_1[f1]}, targets, normalisation, self_scores_1=self_1,
+                                  self_scores_2=self_2)[0]
+            fine.update(((f1, f2), float(sc)) for f2, sc in zip(targets, scores))
+
+    res_dict = {}
+    for f1, f2s in candidates.items():
+        for f2 in f2s:
+            sc = fine.get((f1, f2), fine.get((f2, f1)) if symmetric else None)
+            if sc is not None and sc >= min_score:
                 res_dict[(f1, f2)] = sc
-                if (f2, f1) in res_dict:
-                    assert sc == res_dict[(f2, f1)]
-                else:
-                    res_dict[(f2, f1)] = sc
-    tlog.report(f"[nblast_list_to_list] Stored {len(res_dict)} scores >{min_score}")
+    tlog.report(f"[nblast_coarse_to_fine] Stored {len(res_dict)} scores >{min_score}")
     return res_dict
 
+
+def resolution_drift_report(ids, folder, levels, backend=None, normalisation="mean", reference_opts=None) -> dict:
+    """All-by-all score drift of every dotprops level (name -> dp_opts) against reference_opts.
+
+    Returns name -> {dp_opts, mean_points, seconds, mean_abs_drift, max_abs_drift, rmse, pearson_r},
+    including the "reference" level itself, so that speed can be traded against accuracy.
+    """
+    backend = check_backend(backend)
+    ids = [str(f) for f in resolve_ids(ids, folder)]
+    levels = dict(levels, reference=reference_opts)
+
+    runs = {}
+    for name, opts in levels.items():
+        start = time_now()
+        dps_dict = load_dps(ids, folder, backend=backend, dp_opts=opts)
+        scores = score_matrix(dps_dict, dps_dict, normalisation)
+        seconds = (time_now() - start).total_seconds()
+        num_points = [len(dp_to_arrays(dp)[0]) for dp in dps_dict.values()]
+        runs[name] = (list(dps_dict), scores, seconds, float(np.mean(num_points)) if num_points else 0.0)
+
+    ref_ids, ref_scores, _, _ = runs["reference"]
+    report = {}
+    for name, (level_ids, scores, seconds, mean_points) in runs.items():
+        ref_pos = {f: i for i, f in enumerate(ref_ids)}
+        li = [i for i, f in enumerate(level_ids) if f in ref_pos]
+        ri = [ref_pos[level_ids[i]] for i in li]
+        a, b = scores[np.ix_(li, li)].ravel(), ref_scores[np.ix_(ri, ri)].ravel()
+        diff = a - b
+        report[name] = {
+            "dp_opts": dp_options(levels[name]),
+            "mean_points": mean_points,
+            "seconds": seconds,
+            "mean_abs_drift": float(np.abs(diff).mean()) if len(diff) else 0.0,
+            "max_abs_drift": float(np.abs(diff).max()) if len(diff) else 0.0,
+            "rmse": float(np.sqrt((diff ** 2).mean())) if len(diff) else 0.0,
+            "pearson_r": float(np.corrcoef(a, b)[0, 1]) if len(diff) > 1 and a.std() > 0 and b.std() > 0 else 1.0,
+        }
+        tlog.report(f"[resolution_drift_report] {name}: {report[name]}")
+    return report
+
+
+def read_id_list(path) -> list:
+    # one ID (or SWC file name) per line, blank lines and lines starting with # are skipped
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def _batch_source(ids, folder):
+    # folder may be an SWC directory or a library file, ids a list, an ID list file or None (whole library)
+    if folder is not None and os.path.isfile(folder):
+        folder = NeuronLibrary(folder)
+    if isinstance(ids, str):
+        ids = read_id_list(ids)
+    return resolve_ids(ids, folder), folder
+
+
+def batch_main(argv):
+    """python run_nblast.py batch: streams the scores of a pairwise job to a .npz/.csv/.tsv/.parquet file.
+
+    Options can also come from a JSON --manifest with the same keys (ids1, folder1, ids2, folder2,
+    out, min_score, ...); command line options take precedence. Without ids2/folder2 the job is all-by-all.
+    """
+    parser = argparse.ArgumentParser(prog="run_nblast.py batch", description=batch_main.__doc__.splitlines()[0])
+    parser.add_argument("--manifest", help="JSON file with any of the options below")
+    parser.add_argument("--ids1", help="ID list file (one ID per line); omit to use a whole library")
+    parser.add_argument("--folder1", help="SWC folder or library file of the first list")
+    parser.add_argument("--ids2", help="ID list file of the second list (default: ids1)")
+    parser.add_argument("--folder2", help="SWC folder or library file of the second list (default: folder1)")
+    parser.add_argument("--out", help=f"output file, one of {', '.join(SCORE_FORMATS)}")
+    parser.add_argument("--min-score", type=float, dest="min_score")
+    parser.add_argument("--backend", choices=BACKENDS)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--tile-size", type=int, dest="tile_size")
+    parser.add_argument("--normalisation", choices=NORMALISATIONS)
+    parser.add_argument("--dp-opts", type=json.loads, dest="dp_opts", help='e.g. \'{"max_points": 200}\'')
+    parser.add_argument("--metrics-out", dest="metrics_out", help="export run metrics (.jsonl or .prom)")
+    args = parser.parse_args(argv)
+
+    job = {"min_score": 0.0, "workers": 1, "tile_size": TILE_SIZE, "normalisation": "mean"}
+    if args.manifest:
+        with open(args.manifest) as f:
+            job.update(json.load(f))
+    job.update({k: v for k, v in vars(args).items() if v is not None and k != "manifest"})
+    for key in ["folder1", "out"]:
+        if key not in job:
+            parser.error(f"--{key} is required (on the command line or in the manifest)")
+    if "ids2" not in job and "folder2" not in job:
+        job["ids2"] = job.get("ids1")
+    ids1, folder1 = _batch_source(job.get("ids1"), job["folder1"])
+    ids2, folder2 = _batch_source(job.get("ids2"), job.get("folder2", job["folder1"]))
+
+    start = time_now()
+    tiles = iter_scores(ids1, ids2, folder1, folder2, job["min_score"], backend=job.get("backend"),
+                        workers=job["workers"], tile_size=job["tile_size"], normalisation=job["normalisation"],
+                        dp_opts=job.get("dp_opts"))
+    num_written = write_scores(job["out"], ids1, ids2, tiles)
+    seconds = (time_now() - start).total_seconds()
+    tlog.report(f"[batch] Wrote {num_written} scores >={job['min_score']} for {len(ids1)} X {len(ids2)} SWCs "
+                f"to {job['out']} in {seconds:.1f}s")
+    if job.get("metrics_out"):
+        metrics.export(job["metrics_out"])
+    return num_written
+
+
 if __name__ == "__main__":
+    # NBLAST_PROFILE=out.prof dumps a cProfile of the run, NBLAST_METRICS_OUT=metrics.jsonl|.prom the metrics
+    profile_path = os.environ.get("NBLAST_PROFILE")
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        with profiled(profile_path) if profile_path else nullcontext():
+            batch_main(sys.argv[2:])
+        if os.environ.get("NBLAST_METRICS_OUT"):
+            metrics.export(os.environ["NBLAST_METRICS_OUT"])
+        sys.exit(0)
     if len(sys.argv) != 3:
         print("Usage: python run_nblast.py neuron1.swc neuron2.swc")
+        print("       python run_nblast.py batch --help")
         sys.exit(1)
     file1, file2 = sys.argv[1], sys.argv[2]
     try:
-        score = nblast_file_path_pair(file1, file2)
+        with profiled(profile_path) if profile_path else nullcontext():
+            score = nblast_file_path_pair(file1, file2)
         print(f"NBLAST score between {file1} and {file2}: {score}")
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
+    if os.environ.get("NBLAST_METRICS_OUT"):
+        metrics.export(os.environ["NBLAST_METRICS_OUT"])
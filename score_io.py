@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+
+SCORE_FORMATS = (".npz", ".csv", ".tsv", ".parquet")
+
+
+def write_scores(path, ids1, ids2, score_tiles) -> int:
+    """Writes (rows, cols, scores) tiles, e.g. from run_nblast.iter_scores, to path.
+
+    The format follows the extension: .npz stores a sparse COO matrix (rows, cols, scores plus
+    the two id lists), .csv/.tsv and .parquet store one (id1, id2, score) record per score and
+    are written tile by tile. Returns the number of scores written.
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext not in SCORE_FORMATS:
+        raise ValueError(f"Unsupported score file format '{ext}', expected one of {SCORE_FORMATS}")
+    ids1, ids2 = np.asarray([str(f) for f in ids1]), np.asarray([str(f) for f in ids2])
+    if ext == ".npz":
+        return _write_npz(path, ids1, ids2, score_tiles)
+    elif ext == ".parquet":
+        return _write_parquet(path, ids1, ids2, score_tiles)
+    return _write_delimited(path, ids1, ids2, score_tiles, "," if ext == ".csv" else "\t")
+
+
+def _write_npz(path, ids1, ids2, score_tiles):
+    rows, cols, scores = [], [], []
+    for r, c, s in score_tiles:
+        rows.append(np.asarray(r, dtype=np.int32))
+        cols.append(np.asarray(c, dtype=np.int32))
+        scores.append(np.asarray(s, dtype=np.float64))
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+    scores = np.concatenate(scores) if scores else np.zeros(0)
+    np.savez_compressed(
+        path, rows=rows, cols=cols, scores=scores, ids1=ids1, ids2=ids2, shape=np.array([len(ids1), len(ids2)])
+    )
+    return len(scores)
+
+
+def _write_delimited(path, ids1, ids2, score_tiles, sep):
+    num_written = 0
+    with open(path, "w") as f:
+        f.write(f"id1{sep}id2{sep}score\n")
+        for r, c, s in score_tiles:
+            f.writelines(f"{a}{sep}{b}{sep}{float(v)!r}\n" for a, b, v in zip(ids1[r], ids2[c], s))
+            num_written += len(s)
+    return num_written
+
+
+def _write_parquet(path, ids1, ids2, score_tiles):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Writing .parquet score files requires pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([("id1", pa.string()), ("id2", pa.string()), ("score", pa.float64())])
+    num_written = 0
+    with pq.ParquetWriter(str(path), schema) as writer:
+        for r, c, s in score_tiles:
+            writer.write_table(pa.table({"id1": ids1[r], "id2": ids2[c], "score": np.asarray(s)}, schema=schema))
+            num_written += len(s)
+    return num_written
+
+
+def read_scores_npz(path):
+    """Returns ids1, ids2, rows, cols and scores of an .npz score file written by write_scores."""
+    with np.load(path) as data:
+        return [str(f) for f in data["ids1"]], [str(f) for f in data["ids2"]], data["rows"], data["cols"], data["scores"]
+
+
+def scores_to_dict(ids1, ids2, score_tiles) -> dict:
+    ids1, ids2 = [str(f) for f in ids1], [str(f) for f in ids2]
+    res_dict = {}
+    for r, c, s in score_tiles:
+        res_dict.update(((ids1[i], ids2[j]), float(v)) for i, j, v in zip(r, c, s))
+    return res_dict
@@ -1,9 +1,19 @@
 import json
 import os
+import pickle
+import tempfile
 import navis
-from unittest import TestCase
+import numpy as np
+from unittest import TestCase, mock
 
-from run_nblast import nblast_all_by_all, nblast_list_to_list, nblast_id_pair, load_dp, nblast_dp_pair
+import benchmark
+import nblast_native
+from dp_cache import DotpropsCache
+from run_nblast import nblast_all_by_all, nblast_list_to_list, nblast_id_pair, load_dp, load_dps, nblast_dp_pair, \
+    dp_to_arrays, iter_scores, nblast_top_k, build_library, nblast_coarse_to_fine, resolution_drift_report, metrics, \
+    batch_main, NORMALISATIONS, SYMMETRIC_NORMALISATIONS
+from neuron_library import NeuronLibrary
+from score_io import write_scores, read_scores_npz, scores_to_dict
 
 
 def find_swcs(folder):
@@ -36,11 +46,289 @@ class Test(TestCase):
                 self.assertTrue(k[1] in similar_cell_ids)
             self.assertEqual(sorted(res_d.items()), sorted(res_w.items()), folder)
 
+            # both go through iter_scores, so also check them against the plain pairwise path, with tiles
+            # smaller than the lists so that tiling and mirroring are exercised
+            rids = sorted(similar_cell_ids)
+            dps = load_dps(rids, folder)
+            res_t = nblast_list_to_list(rids[:9], rids[4:], folder, folder, min_score=-0.5, tile_size=4)
+            for f1 in rids[:9]:
+                for f2 in rids[4:]:
+                    sc = nblast_dp_pair(dps[f1], dps[f2])
+                    for res in [res_w, res_t]:
+                        if sc >= -0.5:
+                            self.assertAlmostEqual(sc, res[(f1, f2)], places=9)
+                            self.assertAlmostEqual(sc, res[(f2, f1)], places=9)
+                        else:
+                            self.assertNotIn((f1, f2), res)
+
         # check that NBLASTing different resolutions make sense
         for rid in similar_cell_ids:
             sc = nblast_id_pair(rid, rid, "swc_l2", "swc_lod1")
             print(f"{rid}: {sc}")
 
+    def test_native_parity(self):
+        similar_cell_ids = [720575940632852124,720575940626390018,720575940627514627,720575940621624491,720575940621089741,720575940609617614,720575940636592270,720575940636734382,720575940638642547,720575940609030776,720575940627947772,720575940619559838,720575940612033253,720575940624710653]
+        for folder in ["swc_l2", "swc_lod1"]:
+            rids = set(find_swcs(folder)).intersection(str(rid) for rid in similar_cell_ids)
+            res_r = nblast_all_by_all(rids, folder, min_score=float("-inf"), backend="r")
+            res_n = nblast_all_by_all(rids, folder, min_score=float("-inf"), backend="native")
+            self.assertEqual(sorted(res_r.keys()), sorted(res_n.keys()), folder)
+            max_diff = max(abs(res_r[k] - res_n[k]) for k in res_r)
+            print(f"{folder}: max abs diff between R and native scores: {max_diff}")
+            self.assertLess(max_diff, 1e-3, folder)
+
+            res_d = nblast_list_to_list(rids, rids, folder, folder, min_score=float("-inf"), backend="native")
+            self.assertEqual(sorted(res_d.keys()), sorted(res_n.keys()), folder)
+            for k, v in res_n.items():
+                self.assertAlmostEqual(v, res_d[k], places=9)
+
+    def test_normalisations(self):
+        rids = find_swcs("swc_lod1")[:6]
+        for backend in ["r", "native"]:
+            res = {
+                norm: nblast_all_by_all(rids, "swc_lod1", min_score=float("-inf"), backend=backend, normalisation=norm)
+                for norm in ["forward", "mean", "min", "max"]
+            }
+            for (rid1, rid2), fwd in res["forward"].items():
+                rev = res["forward"][(rid2, rid1)]
+                self.assertAlmostEqual((fwd + rev) / 2, res["mean"][(rid1, rid2)], places=9)
+                self.assertAlmostEqual(min(fwd, rev), res["min"][(rid1, rid2)], places=9)
+                self.assertAlmostEqual(max(fwd, rev), res["max"][(rid1, rid2)], places=9)
+                self.assertAlmostEqual(nblast_dp_pair(load_dp(rid1, "swc_lod1", backend=backend),
+                                                      load_dp(rid2, "swc_lod1", backend=backend)),
+                                       res["mean"][(rid1, rid2)], places=9)
+
+            # overlapping lists reuse directed scores of the shared neurons
+            res_d = nblast_list_to_list(rids[:4], rids[2:], "swc_lod1", "swc_lod1", min_score=float("-inf"),
+                                        backend=backend, normalisation="forward")
+            for k, v in res_d.items():
+                self.assertAlmostEqual(res["forward"][k], v, places=9)
+
+    def test_parallel(self):
+        rids = find_swcs("swc_lod1")[:10]
+        for backend in ["r", "native"]:
+            res_w = nblast_all_by_all(rids, "swc_lod1", min_score=-0.5, backend=backend)
+            res_w_par = nblast_all_by_all(rids, "swc_lod1", min_score=-0.5, backend=backend, workers=2, tile_size=3)
+            self.assertEqual(sorted(res_w.keys()), sorted(res_w_par.keys()), backend)
+            for k, v in res_w.items():
+                self.assertAlmostEqual(v, res_w_par[k], places=9)
+
+            res_d = nblast_list_to_list(rids[:4], rids, "swc_lod1", "swc_lod1", min_score=-0.5, backend=backend)
+            res_d_par = nblast_list_to_list(rids[:4], rids, "swc_lod1", "swc_lod1", min_score=-0.5, backend=backend,
+                                            workers=3, tile_size=2)
+            self.assertEqual(sorted(res_d.items()), sorted(res_d_par.items()), backend)
+
+    def test_streaming(self):
+        rids = find_swcs("swc_lod1")[:10]
+        for backend in ["r", "native"]:
+            res_w = nblast_all_by_all(rids, "swc_lod1", min_score=0.1, backend=backend)
+            tiles = iter_scores(rids, rids, "swc_lod1", "swc_lod1", min_score=0.1, backend=backend, tile_size=3)
+            res_s = scores_to_dict(rids, rids, tiles)
+            self.assertEqual(sorted(res_w.keys()), sorted(res_s.keys()), backend)
+            for k, v in res_w.items():
+                self.assertAlmostEqual(v, res_s[k], places=9)
+
+            with tempfile.TemporaryDirectory() as out_dir:
+                out_path = os.path.join(out_dir, "scores.npz")
+                tiles = iter_scores(rids, rids, "swc_lod1", "swc_lod1", min_score=0.1, backend=backend, tile_size=4)
+                self.assertEqual(len(res_w), write_scores(out_path, rids, rids, tiles))
+                ids1, ids2, rows, cols, scores = read_scores_npz(out_path)
+                for i, j, v in zip(rows, cols, scores):
+                    self.assertAlmostEqual(res_w[(ids1[i], ids2[j])], v, places=9)
+
+    def test_top_k(self):
+        cachero_swcs = find_swcs("swc_cachero")[:3]
+        lod1_swcs = find_swcs("swc_lod1")
+        for backend in ["r", "native"]:
+            res_p = nblast_top_k(cachero_swcs, lod1_swcs, 20, "swc_cachero", "swc_lod1", backend=backend)
+            res_f = nblast_top_k(cachero_swcs, lod1_swcs, 20, "swc_cachero", "swc_lod1", backend=backend,
+                                 prefilter_targets=False)
+            # pruning is exact: recall against the full scan is 1
+            for cid in cachero_swcs:
+                self.assertEqual([rid for rid, _ in res_f[cid]], [rid for rid, _ in res_p[cid]], cid)
+                for (_, sc_f), (_, sc_p) in zip(res_f[cid], res_p[cid]):
+                    self.assertAlmostEqual(sc_f, sc_p, places=9)
+
+    def test_overlapping_lists(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            swc_dir = os.path.join(out_dir, "swc")
+            ids = benchmark.make_synthetic_dataset(swc_dir, 12, 60)
+            # lists larger than a tile, overlapping and in a different order: every directed NBLAST runs once
+            for ids1, ids2 in [(ids[:11], ids[1:]), (ids, ids[::-1]), (ids[2:9], ids)]:
+                for normalisation in NORMALISATIONS:
+                    needed = {(a, b) for a in ids1 for b in ids2}
+                    if normalisation in SYMMETRIC_NORMALISATIONS:
+                        needed |= {(b, a) for a, b in needed}
+                    with mock.patch.object(nblast_native, "nblast_raw", wraps=nblast_native.nblast_raw) as raw:
+                        nblast_list_to_list(ids1, ids2, swc_dir, swc_dir, min_score=-1, backend="native",
+                                            tile_size=3, normalisation=normalisation)
+                    self.assertEqual(len(needed), raw.call_count, normalisation)
+
+            dps = load_dps(ids, swc_dir, backend="native")
+            res_t = nblast_list_to_list(ids[:8], ids[3:], swc_dir, swc_dir, min_score=-1, backend="native",
+                                        tile_size=3)
+            for f1 in ids[:8]:
+                for f2 in ids[3:]:
+                    self.assertAlmostEqual(nblast_dp_pair(dps[f1], dps[f2]), res_t[(f1, f2)], places=9)
+
+    def test_top_k_synthetic(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            swc_dir = os.path.join(out_dir, "swc")
+            ids = benchmark.make_synthetic_dataset(swc_dir, 40, 100)
+            for normalisation in NORMALISATIONS:
+                metrics.reset()
+                res_p = nblast_top_k(ids[:5], ids, 3, swc_dir, swc_dir, backend="native",
+                                     normalisation=normalisation, batch_size=4)
+                self.assertGreater(metrics.snapshot()["counters"]["pairs_pruned"], 0, normalisation)
+                res_f = nblast_top_k(ids[:5], ids, 3, swc_dir, swc_dir, backend="native",
+                                     normalisation=normalisation, prefilter_targets=False)
+                for qid in ids[:5]:
+                    self.assertEqual([rid for rid, _ in res_f[qid]], [rid for rid, _ in res_p[qid]], normalisation)
+                    for (_, sc_f), (_, sc_p) in zip(res_f[qid], res_p[qid]):
+                        self.assertAlmostEqual(sc_f, sc_p, places=9)
+            with self.assertRaises(ValueError):
+                nblast_top_k(ids[:1], ids, 0, swc_dir, swc_dir, backend="native")
+
+    def test_library(self):
+        rids = find_swcs("swc_lod1")[:20]
+        with tempfile.TemporaryDirectory() as lib_dir:
+            lib_path = os.path.join(lib_dir, "swc_lod1.nbl")
+            self.assertEqual(len(rids), build_library(rids, "swc_lod1", lib_path, backend="native", chunk_size=7))
+            library = NeuronLibrary(lib_path)
+            self.assertEqual(rids, library.ids)
+            for backend in ["r", "native"]:
+                res_f = nblast_all_by_all(rids, "swc_lod1", min_score=-0.5, backend=backend)
+                res_l = nblast_all_by_all(None, library, min_score=-0.5, backend=backend)
+                self.assertEqual(sorted(res_f.keys()), sorted(res_l.keys()), backend)
+                for k, v in res_f.items():
+                    self.assertAlmostEqual(v, res_l[k], places=9)
+
+            res_f = nblast_top_k(rids[:2], rids, 5, "swc_lod1", "swc_lod1", backend="native", prefilter_targets=False)
+            res_l = nblast_top_k(rids[:2], None, 5, "swc_lod1", library, backend="native")
+            self.assertEqual(res_f, res_l)
+
+    def test_library_synthetic(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            swc_dir = os.path.join(out_dir, "swc")
+            ids = benchmark.make_synthetic_dataset(swc_dir, 15, 80)
+            lib_path = os.path.join(out_dir, "syn.nbl")
+            self.assertEqual(len(ids), build_library(ids, swc_dir, lib_path, backend="native", chunk_size=4))
+            library = NeuronLibrary(lib_path)
+            self.assertEqual(ids, library.ids)
+            dps = load_dps(ids, swc_dir, backend="native")
+            for rid in ids:
+                for a, b in zip(dp_to_arrays(dps[rid]), library.arrays(rid)):
+                    self.assertTrue(np.array_equal(a, b))
+                self.assertEqual(dps[rid].self_score, library.self_score(rid))
+            self.assertEqual(library, pickle.loads(pickle.dumps(library)))
+
+            res_f = nblast_all_by_all(ids, swc_dir, min_score=-1, backend="native")
+            # workers > 1 sends the library to the worker processes, which reopen the file
+            for workers in [1, 2]:
+                res_l = nblast_all_by_all(None, library, min_score=-1, backend="native", workers=workers, tile_size=4)
+                self.assertEqual(sorted(res_f.keys()), sorted(res_l.keys()), workers)
+                for k, v in res_f.items():
+                    self.assertAlmostEqual(v, res_l[k], places=9)
+
+            res_f = nblast_top_k(ids[:3], ids, 4, swc_dir, swc_dir, backend="native", prefilter_targets=False)
+            res_l = nblast_top_k(ids[:3], None, 4, swc_dir, library, backend="native")
+            self.assertEqual(res_f, res_l)
+
+    def test_multi_resolution(self):
+        rids = find_swcs("swc_l2")[:10]
+        levels = {"resample_1": {"resample": 1.0}, "max_200": {"max_points": 200}, "max_50": {"max_points": 50}}
+        for backend in ["r", "native"]:
+            report = resolution_drift_report(rids, "swc_l2", levels, backend=backend)
+            print(json.dumps(report, indent=2))
+            self.assertEqual(0, report["reference"]["max_abs_drift"])
+            for name in levels:
+                self.assertLessEqual(report[name]["mean_abs_drift"], report[name]["max_abs_drift"])
+            self.assertLessEqual(report["max_50"]["mean_points"], 50)
+
+            # with a threshold below every coarse score all pairs are rescored at full resolution
+            res_w = nblast_all_by_all(rids, "swc_l2", min_score=0.1, backend=backend)
+            res_c = nblast_coarse_to_fine(rids, rids, "swc_l2", "swc_l2", min_score=0.1, threshold=float("-inf"),
+                                          coarse_opts={"max_points": 50}, backend=backend)
+            self.assertEqual(sorted(res_w.keys()), sorted(res_c.keys()), backend)
+            for k, v in res_w.items():
+                self.assertAlmostEqual(v, res_c[k], places=9)
+
+    def test_dp_cache(self):
+        rids = find_swcs("swc_lod1")[:5]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for backend in ["r", "native"]:
+                cache = DotpropsCache(cache_dir)
+                cold = load_dps(rids, "swc_lod1", backend=backend, cache=cache)
+                self.assertEqual((0, len(rids)), (cache.hits, cache.misses))
+                warm = load_dps(rids, "swc_lod1", backend=backend, cache=cache)
+                self.assertEqual((len(rids), len(rids)), (cache.hits, cache.misses))
+                for rid in rids:
+                    for a, b in zip(dp_to_arrays(cold[rid]), dp_to_arrays(warm[rid])):
+                        self.assertTrue(np.array_equal(a, b))
+                    self.assertAlmostEqual(nblast_dp_pair(cold[rid], cold[rids[0]]),
+                                           nblast_dp_pair(warm[rid], warm[rids[0]]), places=9)
+
+            # the size cap evicts least recently used entries
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertEqual(0, cache.size_bytes())
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DotpropsCache(cache_dir)
+            swc_dir = os.path.join(cache_dir, "swc")
+            syn_ids = benchmark.make_synthetic_dataset(swc_dir, 3, 50)
+            load_dps(syn_ids, swc_dir, backend="native", cache=cache)
+            self.assertEqual(cache.size_bytes(), cache.total_bytes)
+            # entries of an edited SWC can still be invalidated by path
+            swc_path = os.path.join(swc_dir, f"{syn_ids[0]}.swc")
+            benchmark.make_synthetic_dataset(swc_dir, 1, 60, seed=1)
+            load_dps(syn_ids[:1], swc_dir, backend="native", cache=cache)
+            self.assertEqual(4, len(cache.entries()))
+            cache.invalidate(swc_path)
+            self.assertEqual(2, len(cache.entries()))
+            self.assertEqual(cache.size_bytes(), cache.total_bytes)
+
+    def test_metrics(self):
+        rids = find_swcs("swc_lod1")[:6]
+        for backend in ["r", "native"]:
+            metrics.reset()
+            res_w = nblast_all_by_all(rids, "swc_lod1", min_score=-1, backend=backend, workers=2, tile_size=3)
+            snap = metrics.snapshot()
+            # worker metrics are merged into the parent
+            self.assertEqual(len(rids) ** 2, snap["pair_latency"]["count"], backend)
+            self.assertEqual(len(res_w), snap["counters"]["scores_stored"], backend)
+            for span in ["swc_parse", "dotprops_build", "scoring", "materialise"]:
+                self.assertGreater(snap["spans"][span]["count"], 0, span)
+            self.assertGreater(snap["pairs_per_sec"], 0)
+            prom = metrics.to_prometheus()
+            self.assertIn(f"nblast_pair_seconds_count {len(rids) ** 2}", prom)
+            self.assertIn('nblast_span_seconds_bucket{span="scoring",le="+Inf"}', prom)
+            self.assertEqual(snap["counters"], json.loads(metrics.to_json_line())["counters"])
+
+    def test_benchmark(self):
+        report = benchmark.run_benchmarks(scales=[(6, 100)], repeats=1)
+        self.assertEqual(len(benchmark.BENCHMARKS) * len(benchmark.BACKENDS), len(report["results"]))
+        for res in report["results"]:
+            self.assertGreater(res["seconds_median"], 0)
+        rows = benchmark.compare_reports(report, report)
+        self.assertEqual(len(report["results"]), len(rows))
+        self.assertFalse(any(row["regression"] for row in rows))
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            ids = benchmark.make_synthetic_dataset(os.path.join(out_dir, "swc"), 8, 80)
+            ids_path = os.path.join(out_dir, "ids.txt")
+            with open(ids_path, "w") as f:
+                f.write("\n".join(ids))
+            for backend in ["r", "native"]:
+                res_w = nblast_all_by_all(ids, os.path.join(out_dir, "swc"), min_score=0.1, backend=backend)
+                out_path = os.path.join(out_dir, "scores.npz")
+                num_written = batch_main(["--ids1", ids_path, "--folder1", os.path.join(out_dir, "swc"), "--out",
+                                          out_path, "--min-score", "0.1", "--backend", backend, "--tile-size", "3"])
+                self.assertEqual(len(res_w), num_written)
+                ids1, ids2, rows, cols, scores = read_scores_npz(out_path)
+                for i, j, v in zip(rows, cols, scores):
+                    self.assertAlmostEqual(res_w[(ids1[i], ids2[j])], v, places=9)
+
     def test_batch_nblast(self):
         fw_rids = {
             "adt": [720575940614309535,720575940603231916,720575940605102694,720575940613345442,720575940619385765,720575940621185050,720575940623543881,720575940626034819,720575940637208718,720575940637469254,720575940604407468,720575940617229632,720575940621239679,720575940623303108,720575940625641196,720575940630066007,720575940632571583,720575940606550706,720575940608341806,720575940608656942,720575940608903122,720575940611015958,720575940611172465,720575940611672746,720575940611920365,720575940612062426,720575940612768106,720575940612856854,720575940613234591,720575940613458669,720575940613775825,720575940613895934,720575940614714299,720575940615322674,720575940616098644,720575940618005531,720575940618115669,720575940618514555,720575940619453861,720575940619893072,720575940620156513,720575940620441821,720575940621453014,720575940621956869,720575940622224553,720575940622602025,720575940623320649,720575940623886266,720575940625449530,720575940625960360,720575940626172490,720575940626199562,720575940626601994,720575940628121143,720575940628337307,720575940628766415,720575940629106438,720575940629140988,720575940629583345,720575940629684792,720575940629836793,720575940629947439,720575940629963779,720575940631652433,720575940633990039,720575940634391950,720575940636917737,720575940637370175,720575940638227253,720575940638583869,720575940638870360,720575940639010392,720575940641886605,720575940644161815,720575940605648002,720575940607846083,720575940607924828,720575940608212548,720575940610568305,720575940610815510,720575940611114262,720575940611494629,720575940615046450,720575940615792523,720575940615967574,720575940616044834,720575940616987426,720575940617219869,720575940618254809,720575940618535303,720575940619413317,720575940620664496,720575940620874996,720575940621074390,720575940621347092,720575940621579179,720575940621669002,720575940621766035,720575940622386056,720575940623997879,720575940624078484,720575940624105876,720575940624421834,720575940624449573,720575940624850434,720575940624884112,720575940625721610,720575940626000016,720575940626365958,720575940626366982,720575940626649098,720575940626745616,720575940626983185,720575940627388047,720575940627466746,720575940628046851,720575940628121399,720575940628396090,720575940628647823,720575940628750718,720575940628914152,720575940629491275,720575940629944407,720575940629957943,720575940630247784,720575940631445452,720575940631473122,720575940631688955,720575940631761433,720575940631857548,720575940631993415,720575940633873007,720575940633990812,720575940634261172,720575940634724494,720575940634743999,720575940635895774,720575940636063406,720575940637836477,720575940637855104,720575940638630366,720575940639011160,720575940640802675,720575940642878368,720575940644528163,720575940644948771],